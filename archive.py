@@ -1,44 +1,174 @@
+from arrivals import generate_arrival_streams
+from cache import ResultCache, canonical_key
+from concurrent.futures import ProcessPoolExecutor
+from main import main
+import json
+import os
+import numpy as np
 
 
+# Iteration number of the validation evaluations, no run gets that far
+VALIDATION = 2 ** 32 - 1
 
-def calculate_gradient(alpha, gamma, iteration, objective, policy,
-                       time_horizon, road_list, rush_hours, orange_time,
-                       theta):
-    c_i = 1 / ((iteration + 1) ** gamma)
-    delta = (2 * np.random.randint(0, 2, size=(len(theta))) - 1)
 
-    theta_p = theta + c_i * delta
-    theta_n = theta - c_i * delta
+def evaluation_seeds(seed, iteration, direction):
+    # The + and - evaluation of a direction use the same random streams (common random numbers), so most of the noise
+    # cancels in their difference
+    arrival_seed = np.random.SeedSequence(seed, spawn_key=(iteration, direction, 0))
+    variate_seed = np.random.SeedSequence(seed, spawn_key=(iteration, direction, 1))
+    return arrival_seed, variate_seed
 
-    objective_p = main(policy, time_horizon, road_list, rush_hours,
-                       orange_time=orange_time, light_times=theta_p, verbose=0)
-    objective_n = main(policy, time_horizon, road_list, rush_hours,
-                       orange_time=orange_time, light_times=theta_n, verbose=0)
 
-    gradient_est = (objective_p - objective_n) / 2 * c_i * delta
+def evaluate(policy, time_horizon, road_list, rush_hours, orange_time, light_times, seed, iteration, direction,
+             cache_path=None):
+    key = None
+    if cache_path is not None:
+        key = canonical_key(light_policy=policy, max_time=time_horizon, roads=road_list, rush_hour=rush_hours,
+                            flow_cars=2, flow_first_car=8, orange_time=orange_time, light_times=light_times,
+                            smart=False, seed=['spsa', seed, iteration, direction])
+        cache = ResultCache(cache_path)
+        cached = cache.get(key)
+        if cached is not None:
+            cache.close()
+            return cached[0]
 
-    return gradient_est
+    arrival_seed, variate_seed = evaluation_seeds(seed, iteration, direction)
+    arrivals = generate_arrival_streams(road_list, time_horizon, rush_hours, np.random.default_rng(arrival_seed))
+    average_wait, average_wait_per_road, _ = main(policy, time_horizon, road_list, rush_hours,
+                                                  orange_time=orange_time, light_times=list(light_times), verbose=0,
+                                                  rng=np.random.default_rng(variate_seed), arrivals=arrivals)
+    if cache_path is not None:
+        cache.put(key, average_wait, average_wait_per_road)
+        cache.close()
+    return average_wait
 
 
-def gradient_decent(alpha, gamma, max_iter, initial_theta, policy, time_horizon, road_list, rush_hours, orange_time):
-    theta = initial_theta
-    current_obj = main(policy, time_horizon, road_list, rush_hours,
-                       orange_time=orange_time, light_times=initial_theta, verbose=0)
-    for i in range(max_iter):
-        loop = True
-        sigma = 100
-        a_i = 1 / (i + 1) ** alpha
+def project(theta, min_green, max_green):
+    # Green times outside [min_green, max_green] are not feasible
+    return np.clip(theta, min_green, max_green)
 
-        gradient = calculate_gradient(alpha, gamma, i, current_obj, policy,
-                                      time_horizon, road_list, rush_hours, orange_time, theta)
-        print(gradient)
 
-        obj = main(policy, time_horizon, road_list, rush_hours,
-                   orange_time=orange_time, light_times=theta, verbose=0)
+def calculate_gradient(executor, gamma, c, iteration, policy, time_horizon, road_list, rush_hours, orange_time, theta,
+                       seed, n_directions, min_green, max_green, rng, cache_path=None):
+    # Average the SPSA gradient estimate over n_directions random +-1 perturbations. All 2 * n_directions simulations
+    # run at the same time. The mean of all evaluations is returned as estimate of the objective at theta, so no extra
+    # simulation is needed for it.
+    c_i = c / ((iteration + 1) ** gamma)
+    deltas = 2 * rng.integers(0, 2, size=(n_directions, len(theta))) - 1
 
-        print(obj)
+    futures = []
+    for direction, delta in enumerate(deltas):
+        for theta_d in (project(theta + c_i * delta, min_green, max_green),
+                        project(theta - c_i * delta, min_green, max_green)):
+            futures.append(executor.submit(evaluate, policy, time_horizon, road_list, rush_hours, orange_time,
+                                           theta_d.tolist(), seed, iteration, direction, cache_path))
+    objectives = np.array([future.result() for future in futures]).reshape(n_directions, 2)
 
-        theta = theta + a_i * -gradient
-        print(theta)
+    # Near the bounds the projection can make the perturbation smaller, use the actual difference between the points
+    gradients = []
+    for delta, (objective_p, objective_n) in zip(deltas, objectives):
+        step = project(theta + c_i * delta, min_green, max_green) - project(theta - c_i * delta, min_green, max_green)
+        step[step == 0] = np.inf
+        gradients.append((objective_p - objective_n) / step)
 
-    pass
\ No newline at end of file
+    return np.mean(gradients, axis=0), float(objectives.mean())
+
+
+def submit_validation(executor, policy, time_horizon, road_list, rush_hours, orange_time, theta, seed, n_validation,
+                      cache_path=None):
+    # Evaluations of theta on the same n_validation replications for every theta, so two thetas are compared on the
+    # same traffic
+    return [executor.submit(evaluate, policy, time_horizon, road_list, rush_hours, orange_time, theta.tolist(), seed,
+                            VALIDATION, replication, cache_path) for replication in range(n_validation)]
+
+
+def read_log(log_path):
+    # Last record of the iteration log, None if there is no log yet
+    if log_path is None or not os.path.exists(log_path):
+        return None
+    record = None
+    with open(log_path) as log:
+        for line in log:
+            if line.strip():
+                record = json.loads(line)
+    return record
+
+
+def gradient_decent(initial_theta, policy, time_horizon, road_list, rush_hours, orange_time, max_iter=100, a=10.0,
+                    c=5.0, alpha=0.602, gamma=0.101, stability=10, n_directions=4, n_validation=4, min_green=5,
+                    max_green=120, patience=10, tol=1e-3, seed=None, log_path=None, n_workers=None, cache_path=None):
+    # SPSA over the four green times of the fixed time controller. The step size is a / (i + 1 + stability) ** alpha
+    # and the perturbation size c / (i + 1) ** gamma. Theta is kept within [min_green, max_green]. The gradient
+    # estimates use fresh random numbers every iteration, so their objective estimates are not comparable between
+    # iterations. Every theta is therefore also evaluated on the same n_validation replications, at the same time as
+    # its gradient. Stops after max_iter iterations, or once the validation objective has not improved by a fraction
+    # tol for patience iterations.
+    # Every iteration is appended to the JSON lines file log_path. If that file exists the run continues where it
+    # stopped, with the seed from the log. With a cache_path the simulations of a rerun come from the ResultCache.
+    # Returns the theta with the best validation objective and that objective.
+    theta = project(np.array(initial_theta, dtype=float), min_green, max_green)
+    start = 0
+    best_theta, best_objective, since_best = theta, np.inf, 0
+
+    record = read_log(log_path)
+    if record is not None:
+        seed = record['seed']
+        theta = np.array(record['theta'])
+        start = record['iteration'] + 1
+        best_theta, best_objective = np.array(record['best_theta']), record['best_objective']
+        since_best = record['since_best']
+    elif seed is None:
+        seed = np.random.SeedSequence().entropy
+        print('Master seed: {}'.format(seed))
+
+    if n_workers is None:
+        n_workers = min(os.cpu_count(), 2 * n_directions + n_validation)
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        for i in range(start, max_iter):
+            if since_best >= patience:
+                break
+            # The perturbations are drawn from their own stream, so a resumed run makes the same choices
+            rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(i, n_directions)))
+            a_i = a / (i + 1 + stability) ** alpha
+
+            validation = submit_validation(executor, policy, time_horizon, road_list, rush_hours, orange_time, theta,
+                                           seed, n_validation, cache_path)
+            gradient, objective = calculate_gradient(executor, gamma, c, i, policy, time_horizon, road_list,
+                                                     rush_hours, orange_time, theta, seed, n_directions, min_green,
+                                                     max_green, rng, cache_path)
+            validation = float(np.mean([future.result() for future in validation]))
+            if validation < best_objective * (1 - tol):
+                best_theta, best_objective, since_best = theta, validation, 0
+            else:
+                since_best += 1
+            print('Iteration {}: light times {}, average wait time {}, validation {}'.format(i, theta.tolist(),
+                                                                                               objective, validation))
+
+            theta = project(theta - a_i * gradient, min_green, max_green)
+
+            if log_path is not None:
+                with open(log_path, 'a') as log:
+                    log.write(json.dumps({'iteration': i, 'seed': seed, 'theta': theta.tolist(),
+                                          'objective': objective, 'validation': validation,
+                                          'gradient': gradient.tolist(), 'best_theta': best_theta.tolist(),
+                                          'best_objective': best_objective, 'since_best': since_best}) + '\n')
+
+        # The last step has not been validated yet
+        if since_best < patience:
+            validation = submit_validation(executor, policy, time_horizon, road_list, rush_hours, orange_time, theta,
+                                           seed, n_validation, cache_path)
+            validation = float(np.mean([future.result() for future in validation]))
+            if validation < best_objective:
+                best_theta, best_objective = theta, validation
+
+    return best_theta.tolist(), best_objective
+
+
+if __name__ == '__main__':
+    roads_list = {'NS': [66, 0.971, 2.04], 'NL': [66, 0.971, 2.04], 'ES': [72, 0.963, 1.99], 'EL': [72, 0.963, 1.99],
+                  'SS': [123, 0.968, 3.44], 'SL': [123, 0.968, 3.44], 'WS': [69, 0.634, 1.61], 'WL': [69, 0.634, 1.61]}
+    policies = {1: ['SL', 'NL'], 2: ['NS', 'SS'], 3: ['ES', 'WS'], 4: ['WL', 'EL'], 5: ['']}
+    rush_hour = [21600, 36000, 54000, 68400]
+
+    print(gradient_decent([40, 40, 40, 60], policies, 3600, roads_list, rush_hour, orange_time=4, max_iter=20,
+                          seed=0, log_path='spsa_log.jsonl'))
@@ -0,0 +1,117 @@
+import math
+import numpy as np
+
+
+# Rush hours that never start, for scenarios with constant arrival rates
+NO_RUSH_HOUR = [math.inf, math.inf, math.inf, math.inf]
+
+
+def in_rush_hour(times, rush_hour):
+    return ((rush_hour[0] < times) & (times < rush_hour[1])) | ((rush_hour[2] < times) & (times < rush_hour[3]))
+
+
+def rush_hour_multiplier(c_time, rush_hour):
+    # Same multiplier as main(), 2 at the peak of a rush hour decreasing linearly to 1 at the edges
+    if rush_hour[0] < c_time < rush_hour[1]:
+        return 2 - (abs(c_time - (rush_hour[0] + (rush_hour[1] - rush_hour[0]) / 2)) / (2 * 60 * 60))
+    if rush_hour[2] < c_time < rush_hour[3]:
+        return 2 - (abs(c_time - (rush_hour[2] + (rush_hour[3] - rush_hour[2]) / 2)) / (2 * 60 * 60))
+    return 1
+
+
+def generate_lane_arrivals(params, max_time, rush_hour, rng, block_size=4096):
+    # Arrival times of one lane, the next arrival is drawn at the time of the previous one like in main(). Outside the
+    # rush hours the time between arrivals does not depend on the clock, so a whole block of arrivals is one cumulative
+    # sum. During a rush hour the multiplier depends on the time of the previous arrival and the arrivals are made one
+    # at a time. The stream ends with the first arrival at or after max_time.
+    a, b, c = params
+    time = -0.5 + a * rng.beta(b, c)
+    blocks = [np.array([time])]
+
+    while time < max_time:
+        if in_rush_hour(time, rush_hour):
+            block = []
+            while in_rush_hour(time, rush_hour) and time < max_time:
+                for draw in rng.beta(b, c, size=block_size).tolist():
+                    time = min(-0.5 + a / rush_hour_multiplier(time, rush_hour) * draw, 1) + time
+                    block.append(time)
+                    if not in_rush_hour(time, rush_hour) or time >= max_time:
+                        break
+            blocks.append(np.array(block))
+        else:
+            block = time + np.cumsum(np.minimum(-0.5 + a * rng.beta(b, c, size=block_size), 1))
+
+            # Stop at the first arrival in a rush hour or past max_time, the arrival after it is drawn differently
+            stop = np.flatnonzero(in_rush_hour(block, rush_hour) | (block >= max_time))
+            if stop.size:
+                block = block[:stop[0] + 1]
+            blocks.append(block)
+            time = block[-1]
+
+    return np.concatenate(blocks)
+
+
+class ArrivalStreams:
+    # Arrival times per lane for a whole run. Arrivals never depend on the lights, so the same streams can be fed to
+    # main() for any light_times and smart setting. Every schedule then sees the same traffic (common random numbers)
+    # and the arrivals are only drawn once.
+    def __init__(self, streams, max_time, rush_hour):
+        self.streams = streams
+        self.max_time = max_time
+        self.rush_hour = list(rush_hour)
+
+    def cursor(self):
+        # Hands out the arrivals of every lane in order, each run of main() needs its own cursor
+        return ArrivalCursor(self)
+
+    def get_num_arrivals(self):
+        return sum(len(stream) for stream in self.streams.values())
+
+    def save(self, path):
+        np.savez_compressed(path, max_time=self.max_time, rush_hour=self.rush_hour,
+                            **{'lane_' + road: stream for road, stream in self.streams.items()})
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            streams = {name[len('lane_'):]: data[name] for name in data.files if name.startswith('lane_')}
+            return cls(streams, float(data['max_time']), data['rush_hour'].tolist())
+
+
+class ArrivalCursor:
+    # A position in every stream. Cursors are copied with a Snapshot, the arrays pickle much faster than iterators.
+    # An arrival can be slightly earlier than the one before it, main() only takes it from the cursor once the one
+    # before arrived. peek_until gives the arrivals in that order, as the running maximum of the stream, so they are
+    # sorted.
+    def __init__(self, arrival_streams):
+        self.streams = arrival_streams.streams
+        self.positions = {road: 0 for road in self.streams}
+        self.bounds = {}
+
+    def next(self, road):
+        # Time of the next arrival on the road, None once the stream is used up
+        position = self.positions[road]
+        stream = self.streams[road]
+        if position == len(stream):
+            return None
+        self.positions[road] = position + 1
+        return stream.item(position)
+
+    def peek_until(self, road, time):
+        # Arrivals on the road before time that are not handed out yet, without handing them out
+        if road not in self.bounds:
+            self.bounds[road] = np.maximum.accumulate(self.streams[road])
+        position = self.positions[road]
+        return self.bounds[road][position:max(position, int(self.bounds[road].searchsorted(time)))]
+
+    def advance(self, road, count):
+        # Hand out the next count arrivals of the road at once, after peek_until returned at least that many
+        self.positions[road] += count
+
+
+def generate_arrival_streams(roads, max_time, rush_hour, rng=None, block_size=4096):
+    if rng is None:
+        rng = np.random.default_rng()
+    streams = {road: generate_lane_arrivals(params, max_time, rush_hour, rng, block_size)
+               for road, params in roads.items()}
+    return ArrivalStreams(streams, max_time, rush_hour)
@@ -0,0 +1,195 @@
+from engine import ScheduledEvents, SimulationStates, LANES
+from main import main
+from network import grid_network, simulate_network
+import argparse
+import json
+import platform
+import time as t
+import tracemalloc
+import numpy as np
+
+
+# Same scenario as the one used in main.py
+ROADS = {'NS': [66, 0.971, 2.04], 'NL': [66, 0.971, 2.04], 'ES': [72, 0.963, 1.99], 'EL': [72, 0.963, 1.99],
+         'SS': [123, 0.968, 3.44], 'SL': [123, 0.968, 3.44], 'WS': [69, 0.634, 1.61], 'WL': [69, 0.634, 1.61]}
+POLICIES = {1: ['SL', 'NL'], 2: ['NS', 'SS'], 3: ['ES', 'WS'], 4: ['WL', 'EL'], 5: ['']}
+RUSH_HOUR = [21600, 36000, 54000, 68400]
+
+
+def scale_roads(roads, factor):
+    # Divide parameter a of every road by factor, which makes the time between arrivals smaller
+    return {road: [params[0] / factor] + list(params[1:]) for road, params in roads.items()}
+
+
+def measure_all(runs, repeats=7):
+    # Median wall time of repeats calls of every run() in the dictionary runs and the peak memory allocated while it
+    # runs. The calls go round the runs, so a change of the load of the machine during the suite affects every case
+    # alike. noise is the interquartile range of the wall times relative to the median, how much the wall time varies
+    # on this machine without counting single outliers. The memory is measured in a separate run, because tracemalloc
+    # slows down the code it traces. run() returns the number of operations it did.
+    times = {name: [] for name in runs}
+    operations = {}
+    for _ in range(repeats):
+        for name, run in runs.items():
+            start = t.perf_counter()
+            operations[name] = run()
+            times[name].append(t.perf_counter() - start)
+
+    results = {}
+    for name, run in runs.items():
+        tracemalloc.start()
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        elapsed = float(np.median(times[name]))
+        results[name] = {'operations': operations[name], 'wall_time': elapsed,
+                         'per_sec': operations[name] / elapsed, 'peak_memory': peak,
+                         'noise': float(np.subtract(*np.percentile(times[name], [75, 25]))) / elapsed}
+    return results
+
+
+def measure(run, repeats=7):
+    return measure_all({'run': run}, repeats)['run']
+
+
+def event_list_run(n_events=200000, n_pending=8):
+    # Keep n_pending events in the future event list and repeatedly take the first one and schedule a new one, this is
+    # the access pattern of the arrivals in main()
+    def run():
+        rng = np.random.default_rng(0)
+        roads = list(ROADS)
+        increments = rng.exponential(1, size=n_events).tolist()
+        scheduled_events = ScheduledEvents()
+        for i in range(n_pending):
+            scheduled_events.schedule_arrival(increments[i], roads[i % len(roads)])
+        for i in range(n_events):
+            event, _ = scheduled_events.get_next_event()
+            scheduled_events.schedule_arrival(event[0] + increments[i], event[1])
+        return n_events
+
+    return run
+
+
+def queues_run(n_operations=200000, queue_length=16):
+    # Enqueue a car on a lane and let the first car of the lane leave, with queue_length cars waiting on every lane
+    def run():
+        states = SimulationStates()
+        for lane in range(len(LANES)):
+            for i in range(queue_length):
+                states.enqueue(LANES[lane], float(i))
+        for i in range(n_operations):
+            road = LANES[i % len(LANES)]
+            states.enqueue(road, float(i))
+            states.departure(road)
+        return 2 * n_operations
+
+    return run
+
+
+def main_run(horizon=3600, smart=False, scale=1, seed=0):
+    roads = scale_roads(ROADS, scale)
+
+    def run():
+        _, _, metrics = main(POLICIES, horizon, roads, RUSH_HOUR, orange_time=4, light_times=[40, 40, 40, 40],
+                             verbose=0, smart=smart, rng=np.random.default_rng(seed))
+        return metrics.get_num_events()
+
+    return run
+
+
+def benchmark_event_list(n_events=200000, n_pending=8):
+    return measure(event_list_run(n_events, n_pending))
+
+
+def benchmark_queues(n_operations=200000, queue_length=16):
+    return measure(queues_run(n_operations, queue_length))
+
+
+def benchmark_main(horizon=3600, smart=False, scale=1, seed=0):
+    return measure(main_run(horizon, smart, scale, seed))
+
+
+def run_suite(quick=False, repeats=7):
+    # Every case gives operations (events for main()), wall_time, per_sec, noise and peak_memory in bytes
+    horizons = [3600] if quick else [3600, 86400]
+    runs = {}
+    for n_pending in [8, 64, 1024]:
+        runs['event_list_pending_{}'.format(n_pending)] = event_list_run(n_pending=n_pending)
+    runs['queues'] = queues_run()
+    for horizon in horizons:
+        for smart in [False, True]:
+            for scale in [1, 2, 10]:
+                name = 'main_horizon_{}_{}_scale_{}'.format(horizon, 'smart' if smart else 'fixed', scale)
+                runs[name] = main_run(horizon, smart, scale)
+    return measure_all(runs, repeats)
+
+
+def benchmark_network_scaling(rows=20, cols=20, horizon=600, max_workers=4, n_regions=None, seed=0):
+    # Events/sec of a rows x cols grid on 1 up to max_workers processes. The regions stay the same for every number of
+    # workers, the results must be the same too.
+    network = grid_network(rows, cols, ROADS, POLICIES)
+    if n_regions is None:
+        n_regions = max_workers
+    results = {}
+    reference = None
+    for n_workers in range(1, max_workers + 1):
+        start = t.perf_counter()
+        average_wait, _, num_events = simulate_network(network, horizon, seed=seed, n_regions=n_regions,
+                                                       n_workers=n_workers)
+        elapsed = t.perf_counter() - start
+        if reference is None:
+            reference = average_wait
+        elif average_wait != reference:
+            raise AssertionError('Results differ between 1 and {} workers'.format(n_workers))
+        results['network_{}x{}_workers_{}'.format(rows, cols, n_workers)] = {
+            'operations': num_events, 'wall_time': elapsed, 'per_sec': num_events / elapsed, 'peak_memory': 0}
+    return results
+
+
+def compare(results, baseline, threshold=0.1):
+    # Cases that use more than threshold more memory than in the baseline, or that are slower than the baseline by more
+    # than threshold plus the noise of both runs. Results without noise are single timings, for them only threshold
+    # counts.
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        speed = result['per_sec'] / baseline[name]['per_sec'] - 1
+        memory = result['peak_memory'] / max(baseline[name]['peak_memory'], 1) - 1
+        band = threshold + result.get('noise', 0) + baseline[name].get('noise', 0)
+        if speed < -band:
+            regressions.append('{}: {:.0%} slower, noise band {:.0%}'.format(name, -speed, band))
+        if memory > threshold:
+            regressions.append('{}: {:.0%} more memory'.format(name, memory))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the simulation engine')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file the results are written to')
+    parser.add_argument('--baseline', help='JSON file of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative change beyond the measured noise that counts as a regression')
+    parser.add_argument('--quick', action='store_true', help='skip the full day horizons')
+    parser.add_argument('--repeats', type=int, default=7, help='timed calls per case, the median counts')
+    parser.add_argument('--network-scaling', type=int, metavar='N',
+                        help='also run a 20x20 network on 1 up to N processes')
+    args = parser.parse_args()
+
+    results = run_suite(args.quick, args.repeats)
+    if args.network_scaling:
+        results.update(benchmark_network_scaling(max_workers=args.network_scaling))
+    for name, result in results.items():
+        print('{}: {:.0f} ops/sec, {:.2f} s +- {:.0%}, peak memory {:.1f} MB'.format(
+            name, result['per_sec'], result['wall_time'], result.get('noise', 0), result['peak_memory'] / 2 ** 20))
+    with open(args.output, 'w') as output:
+        json.dump({'python': platform.python_version(), 'numpy': np.__version__, 'results': results}, output,
+                  indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file)['results'], args.threshold)
+        for regression in regressions:
+            print('Regression: {}'.format(regression))
+        if regressions:
+            raise SystemExit(1)
@@ -0,0 +1,83 @@
+import hashlib
+import json
+import numbers
+import sqlite3
+import time as t
+
+
+# Part of every key, increase it whenever a change to the simulation changes its results so old entries are not used
+MODEL_VERSION = 1
+
+
+def canonical_key(**inputs):
+    # Hash of the inputs that does not depend on the order of dictionaries, on lists versus tuples or on ints versus
+    # floats, so 40 and 40.0 are the same input but 40.000001 is not
+    def canonical(value):
+        if isinstance(value, dict):
+            return {str(k): canonical(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [canonical(v) for v in value]
+        if isinstance(value, bool) or value is None or isinstance(value, str):
+            return value
+        if isinstance(value, numbers.Integral):
+            return str(int(value))
+        if float(value).is_integer():
+            return str(int(float(value)))
+        return repr(float(value))
+
+    text = json.dumps({'model_version': MODEL_VERSION, 'inputs': canonical(inputs)}, sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class ResultCache:
+    # Results of main() in a SQLite file, so they survive between runs and can be shared by the worker processes. Every
+    # process opens its own connection, SQLite does the locking. Counting walks the table, so the number of results is
+    # only checked when the cache is opened, once every tenth of max_entries inserts and when a cache with inserts is
+    # closed. Then the least recently used results over max_entries are removed in one statement. So an open cache
+    # adds at most a tenth of max_entries results over the limit, however short lived the caches are.
+    def __init__(self, path, max_entries=100000, timeout=60):
+        self.path = path
+        self.max_entries = max_entries
+        self.slack = max(max_entries // 10, 1)
+        self.inserts = 0
+        self.connection = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, average_wait REAL, '
+                                'average_wait_per_road TEXT, last_used REAL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)')
+        self.hits = 0
+        self.misses = 0
+        self.evict()
+
+    def get(self, key):
+        # (average_wait, average_wait_per_road) or None if the key is not in the cache
+        row = self.connection.execute('SELECT average_wait, average_wait_per_road FROM results WHERE key = ?',
+                                      (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.connection.execute('UPDATE results SET last_used = ? WHERE key = ?', (t.time(), key))
+        return row[0], json.loads(row[1])
+
+    def put(self, key, average_wait, average_wait_per_road):
+        self.connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+                                (key, average_wait, json.dumps(average_wait_per_road), t.time()))
+        self.inserts += 1
+        if self.inserts >= self.slack:
+            self.inserts = 0
+            self.evict()
+
+    def evict(self):
+        excess = len(self) - self.max_entries
+        if excess > 0:
+            self.connection.execute('DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_used '
+                                    'LIMIT ?)', (excess,))
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def close(self):
+        if self.inserts:
+            self.evict()
+        self.connection.close()
@@ -0,0 +1,101 @@
+from engine import LANE_INDEX
+
+
+class Controller:
+    # Decides the lights of main(). After every orange light get_next_light picks the next green light, get_green_time
+    # gives how long a green light stays on and end_green is asked after every departure at a green light whether to
+    # switch to orange right away. They only use the counters of SimulationStates, which are kept up to date on every
+    # enqueue and departure, so a decision takes the same time however many cars are queued. The light policy is passed
+    # in, light 5 is the orange light.
+    def __init__(self, light_policy):
+        self.light_policy = light_policy
+        self.green_lights = sorted(light for light in light_policy if light != 5)
+
+    def get_next_light(self, states, old_light):
+        # The lights go round in order
+        if old_light // 4 == 1:
+            return 1
+        return old_light + 1
+
+    def get_green_time(self, states, light):
+        raise NotImplementedError
+
+    def end_green(self, states, light):
+        return False
+
+    def get_cycle_order(self, old_light):
+        # The green lights in the order they come after old_light, to break ties the same way as the fixed cycle
+        position = self.green_lights.index(old_light) + 1 if old_light in self.green_lights else 0
+        return self.green_lights[position:] + self.green_lights[:position]
+
+
+class FixedTimeController(Controller):
+    # Every green light stays on for its light time
+    def __init__(self, light_policy, light_times):
+        super().__init__(light_policy)
+        self.light_times = light_times
+
+    def get_green_time(self, states, light):
+        return self.light_times[light - 1]
+
+
+class RatioController(Controller):
+    # The smart controller of main(). A green light gets the share of all light times that its lanes have of the queued
+    # cars and switches to orange as soon as one of its lanes is empty. If no car is queued at all the light stays on
+    # for 10 seconds to prevent rapid switching between lights.
+    def __init__(self, light_policy, light_times):
+        super().__init__(light_policy)
+        self.total_seconds = sum(light_times)
+
+    def get_green_time(self, states, light):
+        total_cars_system = states.get_total_cars()
+        if not total_cars_system:
+            return 10
+        ratio = states.get_phase_length(light) / total_cars_system
+        return self.total_seconds * ratio
+
+    def end_green(self, states, light):
+        return states.get_phase_empty_lanes(light) > 0
+
+
+class MaxPressureController(Controller):
+    # Gives the next green to the light with the highest pressure, for green_time seconds. At a single intersection
+    # nothing is queued downstream, so the pressure is the number of queued cars of the light, or with weight='wait'
+    # the time they have waited so far.
+    def __init__(self, light_policy, green_time=10, weight='cars'):
+        super().__init__(light_policy)
+        if weight not in ('cars', 'wait'):
+            raise ValueError('weight must be cars or wait')
+        self.green_time = green_time
+        self.weight = weight
+
+    def get_pressure(self, states, light):
+        if self.weight == 'cars':
+            return states.get_phase_length(light)
+        return states.get_phase_queued_wait(light)
+
+    def get_next_light(self, states, old_light):
+        return max(self.get_cycle_order(old_light), key=lambda light: self.get_pressure(states, light))
+
+    def get_green_time(self, states, light):
+        return self.green_time
+
+
+class LongestQueueController(Controller):
+    # Gives the next green to the light with the longest single queue and keeps it on until its lanes are empty, for at
+    # most max_green seconds
+    def __init__(self, light_policy, max_green=60):
+        super().__init__(light_policy)
+        self.max_green = max_green
+        self.lanes = {light: [LANE_INDEX[road] for road in light_policy[light] if road in LANE_INDEX]
+                      for light in self.green_lights}
+
+    def get_next_light(self, states, old_light):
+        return max(self.get_cycle_order(old_light),
+                   key=lambda light: max((states.get_lane_length(lane) for lane in self.lanes[light]), default=0))
+
+    def get_green_time(self, states, light):
+        return self.max_green
+
+    def end_green(self, states, light):
+        return not states.get_phase_length(light)
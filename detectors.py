@@ -0,0 +1,223 @@
+from engine import LANES
+import json
+import os
+import numpy as np
+import pandas as pd
+
+
+DAY = 86400
+
+
+def read_chunks(path, columns, chunksize):
+    # DataFrames of at most chunksize rows from a CSV or Parquet file, so the file never has to fit in memory
+    if path.endswith('.parquet'):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('Reading Parquet files needs pyarrow')
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+    else:
+        for chunk in pd.read_csv(path, usecols=columns, chunksize=chunksize):
+            yield chunk
+
+
+def to_seconds(column):
+    # Seconds since the Unix epoch, numbers are taken to be seconds already
+    if pd.api.types.is_numeric_dtype(column):
+        return column.to_numpy(dtype=float)
+    # Timestamps without a time zone are taken to be UTC. Whatever the resolution pandas parses them with, the
+    # difference with the epoch in seconds is the same.
+    times = pd.to_datetime(column, utc=True)
+    return ((times - pd.Timestamp(0, tz='UTC')) / pd.Timedelta(seconds=1)).to_numpy(dtype=float)
+
+
+def ingest_detector_log(path, output_dir, kind='timestamps', time_column='timestamp', lane_column='lane',
+                        count_column='count', chunksize=1000000):
+    # Convert a detector log once to a directory with a raw binary column per lane, which DetectorLog memory-maps. With
+    # kind='timestamps' every row is a car passing the detector of a lane, with kind='counts' every row is the number of
+    # cars in the minute that starts at the time of the row. Lanes are the names of the roads in LANES. The rows of a
+    # lane must be in time order.
+    if kind not in ('timestamps', 'counts'):
+        raise ValueError('kind must be timestamps or counts')
+    os.makedirs(output_dir, exist_ok=True)
+    columns = [time_column, lane_column] + ([count_column] if kind == 'counts' else [])
+    files = {road: open(os.path.join(output_dir, road + '.times'), 'wb') for road in LANES}
+    if kind == 'counts':
+        count_files = {road: open(os.path.join(output_dir, road + '.counts'), 'wb') for road in LANES}
+    last_time = {road: -np.inf for road in LANES}
+    rows = {road: 0 for road in LANES}
+    first, last = np.inf, -np.inf
+
+    try:
+        for chunk in read_chunks(path, columns, chunksize):
+            times = to_seconds(chunk[time_column])
+            lanes = chunk[lane_column].astype(str).to_numpy()
+            unknown = set(np.unique(lanes)) - set(LANES)
+            if unknown:
+                raise ValueError('Unknown lanes in detector log: {}'.format(sorted(unknown)))
+            if len(times):
+                first, last = min(first, times.min()), max(last, times.max())
+
+            for road in LANES:
+                selected = lanes == road
+                lane_times = times[selected]
+                if not len(lane_times):
+                    continue
+                if lane_times[0] < last_time[road] or np.any(np.diff(lane_times) < 0):
+                    raise ValueError('Detector log of lane {} is not in time order'.format(road))
+                last_time[road] = lane_times[-1]
+                rows[road] += len(lane_times)
+                files[road].write(lane_times.astype('<f8').tobytes())
+                if kind == 'counts':
+                    count_files[road].write(chunk[count_column].to_numpy()[selected].astype('<i4').tobytes())
+    finally:
+        for file in files.values():
+            file.close()
+        if kind == 'counts':
+            for file in count_files.values():
+                file.close()
+
+    # Days start at midnight UTC of the first record
+    origin = float(np.floor(first / DAY) * DAY) if rows and np.isfinite(first) else 0.0
+    metadata = {'kind': kind, 'origin': origin, 'end': float(last), 'rows': rows}
+    with open(os.path.join(output_dir, 'metadata.json'), 'w') as file:
+        json.dump(metadata, file)
+    return DetectorLog(output_dir)
+
+
+def map_column(path, dtype, rows):
+    if rows == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=(rows,))
+
+
+class DetectorLog:
+    # A detector log converted by ingest_detector_log. The columns are memory-mapped, only the parts that are replayed
+    # are read from disk.
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'metadata.json')) as file:
+            metadata = json.load(file)
+        self.kind = metadata['kind']
+        self.origin = metadata['origin']
+        self.end = metadata['end']
+        self.times = {road: map_column(os.path.join(directory, road + '.times'), '<f8', rows)
+                      for road, rows in metadata['rows'].items()}
+        self.counts = None
+        if self.kind == 'counts':
+            self.counts = {road: map_column(os.path.join(directory, road + '.counts'), '<i4', rows)
+                           for road, rows in metadata['rows'].items()}
+
+    def __getstate__(self):
+        # Only the directory is pickled, the columns are mapped again instead of being copied
+        return {'directory': self.directory}
+
+    def __setstate__(self, state):
+        self.__init__(state['directory'])
+
+    def get_num_days(self):
+        return int(np.ceil((self.end - self.origin) / DAY)) if self.end >= self.origin else 0
+
+    def day(self, day, scale=1.0, seed=0, window=3600.0):
+        # Arrivals of one day for main(), with the arrival rate multiplied by scale
+        return DetectorArrivals(self, self.origin + day * DAY, scale, seed, window)
+
+    def sample_days(self, n_days, rng, scale=1.0, window=3600.0):
+        # n_days random days, every one with its own seed for the counts and rescaling
+        days = rng.integers(0, self.get_num_days(), size=n_days)
+        return [self.day(int(day), scale, int(rng.integers(2 ** 63)), window) for day in days]
+
+
+class DetectorArrivals:
+    # One day of a DetectorLog as arrival source of main(), it has the same cursor() as ArrivalStreams. Arrivals are
+    # read window seconds at a time. Counts are spread uniformly over their minute. With scale below 1 every arrival is
+    # kept with probability scale, above 1 it also gets copies a uniform time of at most jitter seconds later. The
+    # random numbers of the records of a window only depend on seed, the lane and the window, so a day replays the
+    # same every time.
+    max_time = DAY
+    rush_hour = None
+
+    def __init__(self, log, start, scale=1.0, seed=0, window=3600.0, jitter=1.0):
+        if window <= 60 + jitter:
+            raise ValueError('The window must be longer than a minute plus the jitter')
+        self.log = log
+        self.start = start
+        self.scale = scale
+        self.seed = seed
+        self.window = window
+        self.jitter = jitter
+
+    def cursor(self):
+        return DetectorCursor(self)
+
+    def get_num_windows(self):
+        return int(np.ceil(DAY / self.window))
+
+    def window_arrivals(self, road, window):
+        # Sorted arrival times, in seconds since the start of the day, of the cars that come from the records in the
+        # window. Spreading counts and the copies can move some of them into the next window.
+        rng = np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=(LANES.index(road), window + 1)))
+        window_start = self.start + window * self.window
+        times = self.log.times[road]
+        first, last = np.searchsorted(times, [window_start, window_start + self.window])
+        arrivals = np.array(times[first:last])
+        if self.log.kind == 'counts':
+            counts = np.array(self.log.counts[road][first:last])
+            arrivals = np.repeat(arrivals, counts) + 60.0 * rng.random(counts.sum())
+
+        copies = [arrivals[rng.random(len(arrivals)) < min(self.scale, 1.0)]]
+        extra = self.scale - 1
+        while extra > 0:
+            kept = arrivals[rng.random(len(arrivals)) < min(extra, 1.0)]
+            copies.append(kept + self.jitter * rng.random(len(kept)))
+            extra -= 1
+        return np.sort(np.concatenate(copies)) - self.start
+
+
+class DetectorCursor:
+    # Per lane the arrivals of the windows that are read but not handed out yet and the cars carried into the next
+    # window. The state is plain data so a cursor can be copied with a Snapshot.
+    def __init__(self, detector_arrivals):
+        self.detector_arrivals = detector_arrivals
+        self.window = detector_arrivals.window
+        self.n_windows = detector_arrivals.get_num_windows()
+        self.windows = {road: -1 for road in LANES}
+        self.carried = {road: detector_arrivals.window_arrivals(road, -1) for road in LANES}
+        self.arrivals = {road: np.empty(0) for road in LANES}
+        self.positions = {road: 0 for road in LANES}
+
+    def next_window(self, road):
+        # Read the arrivals of the next window, the cars of the previous window that moved into this one included
+        window = self.windows[road] + 1
+        window_end = (window + 1) * self.detector_arrivals.window
+        arrivals = np.concatenate([self.carried[road], self.detector_arrivals.window_arrivals(road, window)])
+        arrivals = arrivals[arrivals >= 0]
+        arrivals.sort(kind='mergesort')
+        split = np.searchsorted(arrivals, min(window_end, DAY))
+        self.windows[road] = window
+        self.arrivals[road] = np.concatenate([self.arrivals[road][self.positions[road]:], arrivals[:split]])
+        self.positions[road] = 0
+        self.carried[road] = arrivals[split:]
+
+    def next(self, road):
+        # Time of the next arrival on the road, None once the day is over
+        while self.positions[road] == len(self.arrivals[road]):
+            if self.windows[road] + 1 == self.n_windows:
+                return None
+            self.next_window(road)
+        position = self.positions[road]
+        self.positions[road] = position + 1
+        return self.arrivals[road].item(position)
+
+    def peek_until(self, road, time):
+        # Arrivals on the road before time that are not handed out yet, without handing them out. Windows are read until
+        # every arrival before time is read.
+        while (self.windows[road] + 1) * self.window < time and self.windows[road] + 1 < self.n_windows:
+            self.next_window(road)
+        arrivals = self.arrivals[road]
+        return arrivals[self.positions[road]:max(self.positions[road], int(arrivals.searchsorted(time)))]
+
+    def advance(self, road, count):
+        # Hand out the next count arrivals of the road at once, after peek_until returned at least that many
+        self.positions[road] += count
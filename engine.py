@@ -1,91 +1,136 @@
 from queue import Queue
 
+import heapq
+import itertools
 import pandas as pd
 import numpy as np
 from collections import deque
 
 
+# Lanes are numbered in this order, first letter is the direction the cars come from and the second letter (S)traight
+# or (L)eft
+LANES = ['NS', 'NL', 'ES', 'EL', 'SS', 'SL', 'WS', 'WL']
+LANE_INDEX = {road: lane for lane, road in enumerate(LANES)}
+
+
+def get_lane(type_road):
+    try:
+        return LANE_INDEX[type_road]
+    except KeyError:
+        raise ValueError('Not a valid type')
+
+
 class SimulationStates:
     # No queue for right turning since this is always allowed
-    # The queue is filled to the left and popped from the right to allow for FIFO
-    def __init__(self):
-        self.NS = deque()
-        self.NL = deque()
-        self.ES = deque()
-        self.EL = deque()
-        self.SS = deque()
-        self.SL = deque()
-        self.WS = deque()
-        self.WL = deque()
+    # Every lane is a FIFO ring buffer holding the arrival times of the queued cars. The buffers are the rows of one
+    # array that doubles in size when a lane is full, heads holds the position of the first car in each lane and
+    # lengths the number of cars in each lane.
+    # With a light_policy there are also counters per phase, a phase being one of the lights of the policy: the number
+    # of cars queued at its open lanes, the number of its open lanes that are empty and the sum of the arrival times of
+    # its queued cars. Like the sums per lane and in total they are updated on every enqueue and departure, so the
+    # controllers can decide in constant time. The wait of the queued cars is the number of cars times the clock minus
+    # the sum of the arrival times.
+    def __init__(self, capacity=1024, light_policy=None):
+        self.buffers = np.empty((len(LANES), capacity))
+        self.heads = np.zeros(len(LANES), dtype=np.int64)
+        self.lengths = np.zeros(len(LANES), dtype=np.int64)
+        self.capacity = capacity
+        self.total_cars = 0
+        self.arrival_sums = [0.0] * len(LANES)
+        self.total_arrival_sum = 0.0
+
+        light_policy = {} if light_policy is None else light_policy
+        n_phases = max(light_policy, default=0) + 1
+        self.lane_phases = [[light for light, roads in light_policy.items() if road in roads] for road in LANES]
+        self.phase_lengths = [0] * n_phases
+        self.phase_arrival_sums = [0.0] * n_phases
+        self.phase_empty_lanes = [sum(road in LANE_INDEX for road in light_policy.get(light, []))
+                                  for light in range(n_phases)]
         self.light_state = 0
         self.clock = 0.0
         self.time_last_orange = 0
 
+    def grow(self):
+        # Unroll every lane to the start of its row so the lanes stay contiguous in the larger buffer
+        new_buffers = np.empty((len(LANES), 2 * self.capacity))
+        for lane in range(len(LANES)):
+            new_buffers[lane, :self.capacity] = np.roll(self.buffers[lane], -self.heads[lane])
+        self.buffers = new_buffers
+        self.heads[:] = 0
+        self.capacity *= 2
+
+    def departure_lane(self, lane):
+        length = self.lengths.item(lane)
+        if length:
+            head = self.heads.item(lane)
+            self.heads[lane] = (head + 1) % self.capacity
+            self.lengths[lane] = length - 1
+            self.total_cars -= 1
+            time = self.buffers.item(lane, head)
+
+            # Sums go back to exactly zero once their queues are empty, so rounding errors do not build up
+            self.arrival_sums[lane] = self.arrival_sums[lane] - time if length > 1 else 0.0
+            self.total_arrival_sum = self.total_arrival_sum - time if self.total_cars else 0.0
+            for light in self.lane_phases[lane]:
+                self.phase_lengths[light] -= 1
+                if self.phase_lengths[light]:
+                    self.phase_arrival_sums[light] -= time
+                else:
+                    self.phase_arrival_sums[light] = 0.0
+                if length == 1:
+                    self.phase_empty_lanes[light] += 1
+            return time
+
+    def enqueue_lane(self, lane, time):
+        length = self.lengths.item(lane)
+        if length == self.capacity:
+            self.grow()
+        self.buffers[lane, (self.heads.item(lane) + length) % self.capacity] = time
+        self.lengths[lane] = length + 1
+        self.total_cars += 1
+
+        self.arrival_sums[lane] += time
+        self.total_arrival_sum += time
+        for light in self.lane_phases[lane]:
+            self.phase_lengths[light] += 1
+            self.phase_arrival_sums[light] += time
+            if not length:
+                self.phase_empty_lanes[light] -= 1
+
+    def get_lane_length(self, lane):
+        return self.lengths.item(lane)
+
+    def get_queued_wait(self, lane):
+        # Time waited so far by the cars queued in the lane
+        return self.lengths.item(lane) * self.clock - self.arrival_sums[lane]
+
+    def get_phase_length(self, light):
+        return self.phase_lengths[light]
+
+    def get_phase_empty_lanes(self, light):
+        return self.phase_empty_lanes[light]
+
+    def get_phase_queued_wait(self, light):
+        return self.phase_lengths[light] * self.clock - self.phase_arrival_sums[light]
+
+    def get_lane_state(self, lane):
+        # Arrival times of the cars in the lane, first car first
+        positions = (self.heads[lane] + np.arange(self.lengths[lane])) % self.capacity
+        return self.buffers[lane, positions]
+
+    # The functions below keep the interface that uses the names of the roads
     def departure(self, type_road):
-        if type_road == 'NS':
-            if self.NS:
-                return self.NS.pop()[1]
-        elif type_road == 'NL':
-            if self.NL:
-                return self.NL.pop()[1]
-        elif type_road == 'ES':
-            if self.ES:
-                return self.ES.pop()[1]
-        elif type_road == 'EL':
-            if self.EL:
-                return self.EL.pop()[1]
-        elif type_road == 'SS':
-            if self.SS:
-                return self.SS.pop()[1]
-        elif type_road == 'SL':
-            if self.SL:
-                return self.SL.pop()[1]
-        elif type_road == 'WS':
-            if self.WS:
-                return self.WS.pop()[1]
-        elif type_road == 'WL':
-            if self.WL:
-                return self.WL.pop()[1]
-        else:
-            raise ValueError('Not a valid type')
+        return self.departure_lane(get_lane(type_road))
 
     def enqueue(self, type_road, time):
-        if type_road == 'NS':
-            self.NS.appendleft((1, time))
-        if type_road == 'NL':
-            self.NL.appendleft((1, time))
-        if type_road == 'ES':
-            self.ES.appendleft((1, time))
-        if type_road == 'EL':
-            self.EL.appendleft((1, time))
-        if type_road == 'SS':
-            self.SS.appendleft((1, time))
-        if type_road == 'SL':
-            self.SL.appendleft((1, time))
-        if type_road == 'WS':
-            self.WS.appendleft((1, time))
-        if type_road == 'WL':
-            self.WL.appendleft((1, time))
+        self.enqueue_lane(get_lane(type_road), time)
+
+    def get_road_length(self, type_road):
+        return self.get_lane_length(get_lane(type_road))
 
     def get_road_state(self, type_road):
-        if type_road == 'NS':
-            return self.NS
-        elif type_road == 'NL':
-            return self.NL
-        elif type_road == 'ES':
-            return self.ES
-        elif type_road == 'EL':
-            return self.EL
-        elif type_road == 'SS':
-            return self.SS
-        elif type_road == 'SL':
-            return self.SL
-        elif type_road == 'WS':
-            return self.WS
-        elif type_road == 'WL':
-            return self.WL
-        else:
-            raise ValueError('Not a valid type')
+        # A deque of the arrival times like before the ring buffers, get_road_length is cheaper for the length
+        return deque(self.get_lane_state(get_lane(type_road)).tolist())
 
     def change_lights(self, new_value):
         self.light_state = new_value
@@ -105,101 +150,133 @@ class SimulationStates:
         return self.time_last_orange
 
     def all_roads_empty(self):
-        all_empty = True
-        list_roads = [self.NS, self.NL, self.ES, self.EL, self.SS, self.SL, self.WS, self.WL]
-        for road in list_roads:
-            if road:
-                all_empty = False
-        return all_empty
+        return self.total_cars == 0
 
     def get_total_cars(self):
-        list_roads = [self.NS, self.NL, self.ES, self.EL, self.SS, self.SL, self.WS, self.WL]
-        total_cars = 0
+        return self.total_cars
 
-        for road in list_roads:
-            total_cars += len(road)
+    def get_total_queued_wait(self):
+        return self.total_cars * self.clock - self.total_arrival_sum
 
-        return total_cars
+    def clear_lane(self, lane):
+        # Remove all cars from the lane at once
+        length = self.lengths.item(lane)
+        if not length:
+            return
+        lane_sum = self.arrival_sums[lane]
+        self.heads[lane] = 0
+        self.lengths[lane] = 0
+        self.total_cars -= length
+        self.arrival_sums[lane] = 0.0
+        self.total_arrival_sum = self.total_arrival_sum - lane_sum if self.total_cars else 0.0
+        for light in self.lane_phases[lane]:
+            self.phase_lengths[light] -= length
+            if self.phase_lengths[light]:
+                self.phase_arrival_sums[light] -= lane_sum
+            else:
+                self.phase_arrival_sums[light] = 0.0
+            self.phase_empty_lanes[light] += 1
 
-    def get_wait_time_per_road(self, dictionary_time, dictionary_cars):
-        list_roads = ['NS', 'NL', 'ES', 'EL', 'SS', 'SL', 'WS', 'WL']
+    def get_wait_time_per_road(self, dictionary_time, dictionary_cars, waits=None):
+        # Add the time waited by the cars still in the queues to the totals per road and empty the queues. With a waits
+        # dictionary the waits of these cars are also stored in it per road.
         total_time = 0
         num_cars = 0
 
-        for road in list_roads:
-            cont = True
-            total_time_left = 0
-            total_cars_left = 0
-            while cont:
-                try:
-                    total_time_left += self.get_clock() - self.departure(road)
-                    total_cars_left += 1
-                except TypeError:
-                    cont = False
+        for lane, road in enumerate(LANES):
+            lane_waits = self.get_clock() - self.get_lane_state(lane)
+            self.clear_lane(lane)
+
+            # A cumulative sum adds the waits one by one in queue order like departing the cars did, so the totals
+            # stay exactly the same
+            total_time_left = lane_waits.cumsum()[-1].item() if len(lane_waits) else 0
             dictionary_time[road] += total_time_left
-            dictionary_cars[road] += total_cars_left
+            dictionary_cars[road] += len(lane_waits)
             total_time += total_time_left
-            num_cars += total_cars_left
+            num_cars += len(lane_waits)
+            if waits is not None:
+                waits[road] = lane_waits
 
         return dictionary_time, dictionary_cars, total_time, num_cars
 
 
+# Events that are scheduled at exactly the same time are handled departures first, then arrivals, then light changes
+EVENT_PRIORITY = {'departure': 0, 'arrival': 1, 'light_change': 2}
+
+# Placeholder for events that are cancelled but still in the heap
+CANCELLED = None
+
+
 class ScheduledEvents:
     # First letter stands for (D)eparture/(A)rrival, second for (N)orth / (E)est etc and the third for (S)traight or
     # (L)eft.
+    # All events are kept in one binary heap of [time, priority, sequence number, type event, event] entries. The
+    # sequence number makes sure events with the same time and type are handled in the order they were scheduled.
+    # Cancelled events stay in the heap and are skipped once they reach the top.
     def __init__(self):
-        self.departures = deque()
-        self.arrivals = deque()
-        self.light_change = deque()
-        self.list_queues = [self.departures, self.arrivals, self.light_change]
+        self.events = []
+        self.counter = itertools.count()
+        self.num_cancelled = 0
+        # Light changes that are still in the heap, so they can be cancelled without searching the heap
+        self.pending_light_changes = {}
+
+    def __getstate__(self):
+        # The counter is saved as the next sequence number, itertools.count can not be pickled in every Python version
+        state = self.__dict__.copy()
+        state['counter'] = next(self.counter)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.counter = itertools.count(state['counter'])
 
     def get_next_event(self):
-        min_time = np.inf
-        next_event = None
-        type_event = None
-        type_queue = None
-        for queue in self.list_queues:
-            if queue:
-                if queue[0][0] < min_time:
-                    type_queue = queue
-                    next_event = queue[0]
-                    min_time = queue[0][0]
-                    if type_queue == self.arrivals:
-                        type_event = 'arrival'
-                    if type_queue == self.departures:
-                        type_event = 'departure'
-                    if type_queue == self.light_change:
-                        type_event = 'light_change'
-
-        type_queue.popleft()
-        self.list_queues = [self.departures, self.arrivals, self.light_change]
-        return next_event, type_event
+        while self.events:
+            entry = heapq.heappop(self.events)
+            next_event = entry[-1]
+            if next_event is CANCELLED:
+                self.num_cancelled -= 1
+                continue
+
+            # Mark the entry as handled so cancelling it afterwards has no effect
+            entry[-1] = CANCELLED
+            type_event = entry[3]
+            if type_event == 'light_change':
+                del self.pending_light_changes[entry[2]]
+            return next_event, type_event
+
+        raise IndexError('No scheduled events')
+
+    def schedule(self, time, type, type_event):
+        entry = [time, EVENT_PRIORITY[type_event], next(self.counter), type_event, (time, type)]
+        heapq.heappush(self.events, entry)
+        return entry
 
     def schedule_arrival(self, time, type):
-        self.arrivals.appendleft((time, type))
-        self.sort_arrivals()
-        self.list_queues = [self.departures, self.arrivals, self.light_change]
+        return self.schedule(time, type, 'arrival')
 
     def schedule_departure(self, time, type):
-        self.departures.appendleft((time, type))
-        self.sort_departures()
-        self.list_queues = [self.departures, self.arrivals, self.light_change]
+        return self.schedule(time, type, 'departure')
 
     def schedule_light_change(self, time, type):
-        self.light_change.appendleft((time, type))
-        self.list_queues = [self.departures, self.arrivals, self.light_change]
-
-    def sort_arrivals(self):
-        self.arrivals = deque(sorted(self.arrivals, key=lambda time: time[0]))
-        self.list_queues = [self.departures, self.arrivals, self.light_change]
+        entry = self.schedule(time, type, 'light_change')
+        self.pending_light_changes[entry[2]] = entry
+        return entry
 
-    def sort_departures(self):
-        self.departures = deque(sorted(self.departures, key=lambda time: time[0]))
-        self.list_queues = [self.departures, self.arrivals, self.light_change]
+    def cancel(self, entry):
+        # Cancelling an event that was already handled or cancelled does nothing
+        if entry[-1] is not CANCELLED:
+            entry[-1] = CANCELLED
+            self.num_cancelled += 1
+            self.pending_light_changes.pop(entry[2], None)
 
     def clear_light_change(self):
-        self.light_change = deque()
+        for entry in list(self.pending_light_changes.values()):
+            self.cancel(entry)
+
+    def get_num_events(self):
+        return len(self.events) - self.num_cancelled
 
 
-def draw_exponential(rate):
-    return np.random.exponential(rate)
+def draw_exponential(rate, rng=np.random):
+    return rng.exponential(rate)
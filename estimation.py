@@ -0,0 +1,117 @@
+from statistics import NormalDist
+import math
+import numpy as np
+
+
+def t_probability(t, df):
+    # Probability that the absolute value of a t distributed variable with df degrees of freedom is below t, for a
+    # whole number df, from the finite sums in Abramowitz and Stegun 26.7.3 and 26.7.4
+    theta = math.atan(t / math.sqrt(df))
+    cos2 = math.cos(theta) ** 2
+    if df % 2:
+        term, total = math.cos(theta), 0.0
+        for k in range(1, (df - 1) // 2 + 1):
+            total += term
+            term *= cos2 * (2 * k) / (2 * k + 1)
+        return 2 / math.pi * (theta + math.sin(theta) * total) if df > 1 else 2 / math.pi * theta
+    term, total = 1.0, 0.0
+    for k in range(1, df // 2 + 1):
+        total += term
+        term *= cos2 * (2 * k - 1) / (2 * k)
+    return math.sin(theta) * total
+
+
+def t_quantile(confidence, df):
+    # Two sided quantile of Student's t distribution with df degrees of freedom. The expansion in Abramowitz and Stegun
+    # 26.7.5 is only good to about three decimals for df >= 3 and 11% too small for df = 1, so for df up to 1000 it is
+    # the start of Newton steps on t_probability. The probability is concave in t, so the steps come from below and
+    # converge without overshooting.
+    z = NormalDist().inv_cdf(1 - (1 - confidence) / 2)
+    t = (z + (z ** 3 + z) / (4 * df) + (5 * z ** 5 + 16 * z ** 3 + 3 * z) / (96 * df ** 2)
+         + (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z) / (384 * df ** 3)
+         + (79 * z ** 9 + 776 * z ** 7 + 1482 * z ** 5 - 1920 * z ** 3 - 945 * z) / (92160 * df ** 4))
+    if df > 1000:
+        return t
+    df = int(df)
+    log_density = math.lgamma((df + 1) / 2) - math.lgamma(df / 2) - 0.5 * math.log(df * math.pi)
+    for _ in range(100):
+        density = math.exp(log_density - (df + 1) / 2 * math.log1p(t * t / df))
+        step = (confidence - t_probability(t, df)) / (2 * density)
+        t += step
+        if abs(step) <= 1e-12 * t:
+            break
+    return t
+
+
+def confidence_interval(values, confidence=0.95):
+    # Mean and half width of the t confidence interval of the mean of independent values
+    values = np.asarray(values, dtype=float)
+    if len(values) < 2:
+        return values.mean(), math.inf
+    half_width = t_quantile(confidence, len(values) - 1) * values.std(ddof=1) / math.sqrt(len(values))
+    return values.mean(), half_width
+
+
+class BatchMeans:
+    # Means of consecutive batches of a stream of observations, in at most max_batches batches. An observation has a
+    # weight, 1 to count observations or a duration for time averages, and a batch holds batch_size weight. Once all
+    # batches are full every two neighbouring batches are merged and batch_size doubles, so memory stays constant
+    # however long the stream is.
+    def __init__(self, batch_size=1.0, max_batches=1024):
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self.means = []
+        self.current_sum = 0.0
+        self.current_weight = 0.0
+        self.total_weight = 0.0
+
+    def add(self, value, weight=1.0):
+        self.total_weight += weight
+        while weight > 0:
+            take = min(weight, self.batch_size - self.current_weight)
+            self.current_sum += value * take
+            self.current_weight += take
+            weight -= take
+            if self.current_weight >= self.batch_size:
+                self.means.append(self.current_sum / self.current_weight)
+                self.current_sum = 0.0
+                self.current_weight = 0.0
+                if len(self.means) == self.max_batches:
+                    self.means = [(self.means[i] + self.means[i + 1]) / 2 for i in range(0, len(self.means), 2)]
+                    self.batch_size *= 2
+
+    def get_means(self):
+        return np.array(self.means)
+
+    def estimate(self, confidence=0.95, n_batches=20):
+        # Mean and confidence interval after deleting the warm-up found by MSER. warmup is the weight that was deleted,
+        # stationary is False if MSER wants to delete half of the run or more, then there probably is no steady state.
+        means = self.get_means()
+        truncation = mser(means)
+        mean, half_width = batch_means_interval(means[truncation:], confidence, n_batches)
+        return {'mean': float(mean), 'half_width': float(half_width), 'warmup': truncation * self.batch_size,
+                'stationary': truncation < len(means) // 2 - 1}
+
+
+def mser(means):
+    # Number of leading batch means to delete, the truncation that minimises the MSER statistic
+    # sum((x_i - mean_d) ** 2) / (n - d) ** 2 over the first half of the series
+    n = len(means)
+    if n < 4:
+        return 0
+    tail_count = np.arange(n, 0, -1)
+    tail_sum = np.cumsum(means[::-1])[::-1]
+    tail_squares = np.cumsum(means[::-1] ** 2)[::-1]
+    statistic = (tail_squares - tail_sum ** 2 / tail_count) / tail_count ** 2
+    return int(np.argmin(statistic[:n // 2]))
+
+
+def batch_means_interval(means, confidence=0.95, n_batches=20):
+    # Group the batch means into n_batches larger batches of equal size, leading means that do not fit are dropped,
+    # and take the t confidence interval of their means
+    n_batches = min(n_batches, len(means))
+    if n_batches < 2:
+        return (means.mean() if len(means) else math.nan), math.inf
+    size = len(means) // n_batches
+    grouped = means[len(means) - size * n_batches:].reshape(n_batches, size).mean(axis=1)
+    return confidence_interval(grouped, confidence)
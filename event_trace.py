@@ -0,0 +1,107 @@
+from engine import LANES
+import numpy as np
+
+
+# Kinds of traced events
+ARRIVAL_PASS = 0
+ARRIVAL_QUEUE = 1
+DEPARTURE = 2
+ORANGE_DEPARTURE = 3
+ORANGE_STOP = 4
+LIGHT_CHANGE = 5
+EVENT_NAMES = ['arrival passes through', 'arrival queued', 'departure', 'departure on orange', 'stopped at orange',
+               'light change']
+
+# One record per event. lane is -1 for light changes, light is the light state after the event, queue_length the
+# number of cars in the lane after the event (in the system for light changes) and wait the time waited by a departing
+# car, NaN for other events.
+TRACE_DTYPE = np.dtype([('time', '<f8'), ('kind', 'u1'), ('lane', 'i1'), ('light', 'u1'), ('queue_length', '<i4'),
+                        ('wait', '<f8')])
+
+# The .npy header is written with a fixed length, so it can be rewritten with the final number of records on close
+HEADER_LENGTH = 256
+
+
+def npy_header(n_records):
+    header = repr({'descr': np.lib.format.dtype_to_descr(TRACE_DTYPE), 'fortran_order': False,
+                   'shape': (n_records,)})
+    header = header.ljust(HEADER_LENGTH - 10 - 1) + '\n'
+    if len(header) != HEADER_LENGTH - 10:
+        raise ValueError('Trace header does not fit in {} bytes'.format(HEADER_LENGTH))
+    return b'\x93NUMPY\x01\x00' + np.uint16(len(header)).tobytes() + header.encode('latin1')
+
+
+class TraceRecorder:
+    # Records the events of main() in a preallocated structured array. Once the array is full it is appended to the
+    # .npy file at path, so memory use does not depend on the length of the run. Without a path the chunks are kept in
+    # memory. close() must be called to finish the file, or use the recorder as a context manager.
+    def __init__(self, path=None, chunk_size=65536):
+        self.path = path
+        self.buffer = np.empty(chunk_size, dtype=TRACE_DTYPE)
+        self.position = 0
+        self.n_records = 0
+        self.chunks = []
+        self.file = None
+        if path is not None:
+            self.file = open(path, 'wb')
+            self.file.write(npy_header(0))
+
+    def record(self, time, kind, lane, light, queue_length, wait=np.nan):
+        self.buffer[self.position] = (time, kind, lane, light, queue_length, wait)
+        self.position += 1
+        if self.position == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        if self.file is not None:
+            self.file.write(self.buffer[:self.position].tobytes())
+        else:
+            self.chunks.append(self.buffer[:self.position].copy())
+        self.n_records += self.position
+        self.position = 0
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.seek(0)
+            self.file.write(npy_header(self.n_records))
+            self.file.close()
+            self.file = None
+
+    def get_trace(self):
+        # All records of the trace. A trace with a path is read back from the file, which is only complete after close()
+        if self.path is not None:
+            if self.file is not None:
+                raise ValueError('The trace file is only complete after close()')
+            return load_trace(self.path)
+        return np.concatenate(self.chunks + [self.buffer[:self.position]])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PrintTrace:
+    # Prints the events instead of recording them, this is what main() uses for verbose=1
+    def record(self, time, kind, lane, light, queue_length, wait=np.nan):
+        if kind == LIGHT_CHANGE:
+            print('{}: light change to light state {}, {} cars in the system'.format(time, light, queue_length))
+        elif kind in (DEPARTURE, ORANGE_DEPARTURE):
+            print('{}: {} at road {}, waited {}, {} cars left'.format(time, EVENT_NAMES[kind], LANES[lane], wait,
+                                                                      queue_length))
+        else:
+            print('{}: {} at road {}, {} cars in the queue'.format(time, EVENT_NAMES[kind], LANES[lane], queue_length))
+
+
+def load_trace(path):
+    # The trace as a read-only memory-mapped structured array, columns are read from disk when they are used
+    return np.load(path, mmap_mode='r')
+
+
+def iter_trace(path, chunk_size=1 << 20):
+    # Go through a large trace in chunks of chunk_size records
+    trace = load_trace(path)
+    for start in range(0, len(trace), chunk_size):
+        yield np.array(trace[start:start + chunk_size])
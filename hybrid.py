@@ -0,0 +1,369 @@
+from arrivals import generate_arrival_streams
+from bisect import bisect_left
+from engine import SimulationStates, ScheduledEvents, LANE_INDEX, CANCELLED
+from estimation import confidence_interval
+from main import main
+from snapshot import Snapshot
+import time as t
+import numpy as np
+
+
+class HandoverSnapshot(Snapshot):
+    # The snapshots of a hybrid run are only used once, so main() can continue from them without a copy
+    def copy(self):
+        return self
+
+    @staticmethod
+    def of(snapshot):
+        return HandoverSnapshot(snapshot.states, snapshot.scheduled_events, snapshot.variates, snapshot.arrival_cursor,
+                                snapshot.metrics, snapshot.totals)
+
+
+class SharedCursorArrivals:
+    # Arrival source for main() that hands out the one cursor of a hybrid run. Besides next the cursor has peek_until
+    # and advance, so the fluid cycles can look at the arrivals of a whole cycle and hand them out at once.
+    def __init__(self, cursor, max_time, rush_hour):
+        self.shared_cursor = cursor
+        self.max_time = max_time
+        self.rush_hour = rush_hour
+
+    def cursor(self):
+        return self.shared_cursor
+
+
+def get_green_windows(light_policy, green_times, orange_time):
+    # Start and end of the green light of every lane relative to the start of light 1, and the length of a full cycle
+    windows = {}
+    offset = 0
+    for light in range(1, 5):
+        for road in light_policy[light]:
+            if road in LANE_INDEX:
+                windows[road] = (offset, offset + green_times[light - 1])
+        offset += green_times[light - 1] + orange_time
+    return windows, offset
+
+
+def orange_departures(road, queued, head, arrivals, position, departure, orange_start, orange_time, flow_cars, variates,
+                      waits, longest):
+    # Departures that go on during an orange light. Like in main() every car goes with a probability that drops from 1
+    # to 0 during the orange light, the departures stop at the first car that does not go or when the lane is empty.
+    # Cars that arrive during the orange light always queue.
+    while departure < orange_start + orange_time:
+        end = bisect_left(arrivals, departure, position)
+        queued.extend(arrivals[position:end])
+        position = end
+        longest = max(longest, len(queued) - head)
+        if head == len(queued) or variates.uniform() <= (departure - orange_start) / orange_time:
+            break
+        waits.append(departure - queued[head])
+        head += 1
+        departure += variates.exponential(road, flow_cars)
+    return head, position, longest
+
+
+def fluid_lane(road, queue, arrivals, start, boundary, n_cycles, window, cycle_time, orange_time, departure, flow_cars,
+               flow_first_car, max_queue, variates):
+    # Up to n_cycles light cycles of a lane from boundary in one go, with the same rules and draws as main(). The
+    # departures start with a draw with mean flow_first_car after the start of the green light and follow each other
+    # with draws with mean flow_cars. They stop at the first departure that finds the lane empty, so cars that arrive
+    # when the lane is empty pass straight through, or go on into the orange light. A departure that is still going on
+    # during the orange light before boundary starts at departure. The sorted arrivals are taken in slices, only the
+    # cars that queue are touched one by one.
+    # The lane stops before the first cycle in which it can have more than max_queue cars queued at the start of its
+    # green light, counting every car that arrives before it. That is known before any draw of the cycle, for the first
+    # cycle also before the departures during the orange light before it. Returns the waits, the arrival times of the
+    # cars that queued, of which the first ones left in the order of the waits, and for every cycle that was simulated
+    # the number of cars that left, the number of cars that queued, the position in arrivals and the longest queue at
+    # its end. The queue is longest at the start of the green light or of a departure, the cars that arrived before are
+    # queued then and none left yet.
+    waits = []
+    queued = list(queue)
+    head = 0
+    position = 0
+    longest = len(queued)
+    marks = []
+    if window is None:
+        # A lane that is never green only queues
+        end = bisect_left(arrivals, boundary + n_cycles * cycle_time)
+        if len(queued) + end > max_queue:
+            n_cycles = 0
+        for cycle in range(n_cycles):
+            end = bisect_left(arrivals, boundary + (cycle + 1) * cycle_time, position)
+            queued.extend(arrivals[position:end])
+            position = end
+            marks.append((0, len(queued), position, len(queued)))
+        return waits, queued, marks
+    if len(queued) + bisect_left(arrivals, boundary + window[0]) > max_queue:
+        return waits, queued, marks
+    if departure is not None:
+        head, position, longest = orange_departures(road, queued, head, arrivals, position, departure,
+                                                    boundary - orange_time, orange_time, flow_cars, variates, waits,
+                                                    longest)
+
+    for cycle in range(n_cycles):
+        cycle_start = boundary + cycle * cycle_time
+        green_start, green_end = cycle_start + window[0], cycle_start + window[1]
+        end = bisect_left(arrivals, green_start, position)
+        if len(queued) - head + end - position > max_queue:
+            break
+        queued.extend(arrivals[position:end])
+        position = end
+        longest = max(longest, len(queued) - head)
+
+        departure = green_start + variates.exponential(road, flow_first_car)
+        while departure < green_end and head < len(queued):
+            # The lane was not empty since the previous departure, so the cars that arrived in between queued
+            end = bisect_left(arrivals, departure, position)
+            if end > position:
+                queued.extend(arrivals[position:end])
+                position = end
+                longest = max(longest, len(queued) - head)
+            waits.append(departure - queued[head])
+            head += 1
+            departure += variates.exponential(road, flow_cars)
+
+        # Cars that arrive during the green light queue if the lane is not empty and pass otherwise, the lane stays
+        # empty once it is. If the next departure is after the end of the green light it can still find cars that
+        # arrived during the orange light.
+        end = bisect_left(arrivals, green_end, position)
+        if head < len(queued):
+            queued.extend(arrivals[position:end])
+            longest = max(longest, len(queued) - head)
+        position = end
+        if departure >= green_end:
+            head, position, longest = orange_departures(road, queued, head, arrivals, position, departure, green_end,
+                                                        orange_time, flow_cars, variates, waits, longest)
+
+        # The cars that arrive later in the cycle wait for the next one
+        end = bisect_left(arrivals, cycle_start + cycle_time, position)
+        queued.extend(arrivals[position:end])
+        position = end
+        longest = max(longest, len(queued) - head)
+        marks.append((head, len(queued), position, longest))
+    return waits, queued, marks
+
+
+def fluid_cycles(queues, pending, departures, cursor, start, boundary, n_cycles, windows, cycle_time, orange_time,
+                 flow_cars, flow_first_car, max_queue, variates):
+    # Simulate up to n_cycles light cycles from boundary as fluid cycles, between start and boundary is the end of the
+    # orange light before light 1. The lanes run one after the other and every lane stops at the first cycle that is too
+    # busy for it, so the lanes after it run fewer cycles and all lanes keep the cycles up to the shortest. The draws of
+    # the cycles that are not kept are dropped, the choice of the cycles only depends on earlier draws. pending has the
+    # arrival per lane that main() took from the cursor but did not handle yet, it is removed once it is used. Returns
+    # the number of cycles and per lane the waits, the cars queued at the end, the longest queue and the car seconds
+    # queued between start and the end of the cycles.
+    lanes = {}
+    for road, queue in queues.items():
+        end = boundary + n_cycles * cycle_time
+        if pending.get(road, -np.inf) >= end:
+            # Like in main() the arrivals after the pending one are only handed out once it has arrived
+            arrivals = []
+        else:
+            arrivals = cursor.peek_until(road, end).tolist()
+            if road in pending:
+                arrivals.insert(0, pending[road])
+        waits, queued, marks = fluid_lane(road, queue, arrivals, start, boundary, n_cycles, windows.get(road),
+                                          cycle_time, orange_time, departures.get(road), flow_cars, flow_first_car,
+                                          max_queue, variates)
+        lanes[road] = waits, queued, marks
+        n_cycles = len(marks)
+        if not n_cycles:
+            return 0, None
+
+    end = boundary + n_cycles * cycle_time
+    results = {}
+    for road, (waits, queued, marks) in lanes.items():
+        left, n_queued, position, longest = marks[n_cycles - 1]
+        carried = queued[left:n_queued]
+        area = sum(wait - max(start - arrival, 0.0) for arrival, wait in zip(queued, waits[:left]))
+        area += sum(end - max(arrival, start) for arrival in carried)
+        results[road] = waits[:left], carried, longest, area
+        if road in pending and pending[road] < end:
+            del pending[road]
+            position -= 1
+        cursor.advance(road, position)
+    return n_cycles, results
+
+
+def get_handover(snapshot, first_green):
+    # Pending arrival per lane, departures during the orange light and the start of light 1 of a run of main() that
+    # stopped around the start of a light cycle, during the orange light before light 1 or right after light 1 turned
+    # green. The boundary is None if the run stopped anywhere else.
+    pending = {}
+    departures = {}
+    boundary = None
+    light = snapshot.states.get_light_state()
+    for entry in snapshot.scheduled_events.events:
+        if entry[-1] is CANCELLED:
+            continue
+        time, type = entry[-1]
+        if entry[3] == 'arrival':
+            # main() takes the next arrival of a lane from the cursor once the previous one arrived
+            pending[type] = time
+        elif entry[3] == 'departure' and light == 5:
+            departures[type] = time
+        elif entry[3] == 'light_change' and light == 5 and type == 1:
+            boundary = time
+        elif entry[3] == 'light_change' and light == 1 and time == snapshot.get_clock() + first_green:
+            boundary = snapshot.get_clock()
+    if light != 5 or boundary is None:
+        departures = {}
+    return pending, {road: time for road, time in departures.items() if time < boundary}, boundary
+
+
+def exact_snapshot(light_policy, roads, boundary, queues, pending, cursor, variates, metrics, totals, green_times,
+                   flow_first_car):
+    # State of main() at the start of light 1 at boundary after fluid cycles, the same events as init_simulation. Lanes
+    # with a pending arrival get that one instead of the next of the cursor.
+    states = SimulationStates(light_policy=light_policy)
+    states.change_lights(1)
+    states.advance_clock(boundary)
+    for road, queue in queues.items():
+        for time in queue:
+            states.enqueue(road, time)
+
+    scheduled_events = ScheduledEvents()
+    for road in roads:
+        time = pending[road] if road in pending else cursor.next(road)
+        if time is not None:
+            scheduled_events.schedule_arrival(time, road)
+    for road in light_policy[1]:
+        scheduled_events.schedule_departure(boundary + variates.exponential(road, flow_first_car), road)
+    scheduled_events.schedule_light_change(boundary + green_times[0], 5)
+    return HandoverSnapshot(states, scheduled_events, variates, cursor, metrics, totals)
+
+
+def main_hybrid(light_policy, max_time, roads, rush_hour, flow_cars=2, flow_first_car=8, orange_time=1,
+                light_times=[40, 30, 20, 60], rng=None, arrivals=None, max_queue=10, max_exact_cycles=64,
+                max_fluid_cycles=64):
+    # Runs main() with the fixed time controller, but light cycles with little traffic are simulated as fluid cycles:
+    # the arrivals of the whole cycle are handed out at once and only the cars that have to wait get departure draws, so
+    # a cycle costs a few list operations per lane instead of events for every car. The fluid cycles are tried in
+    # stretches of 1, 2, 4, ... up to max_fluid_cycles cycles that every lane runs in one go. The departures follow the
+    # same rules with the same distributions as in main(), including the orange light. A cycle is fluid if no lane can
+    # have more than max_queue cars queued at the start of its green light, which is decided from the arrivals before
+    # any draw. max_queue is the threshold between low and high load, a wrong guess of the load only costs time. The
+    # metrics get the waits, the longest queues and the car seconds of the fluid cycles, so the average number of cars
+    # covers the whole run, but the events and the largest number of cars are only those of main() and the time series
+    # is NaN where it only has fluid cycles. When a cycle is too busy main() takes over from the state at the start of
+    # that cycle for 1, 2, 4, ... up to max_exact_cycles cycles before a fluid cycle is tried again. The last partial
+    # cycle is always exact. Without arrivals the arrival streams are generated from rng. Returns the results of main()
+    # and a dictionary with the number of fluid cycles, the simulated time they cover and the number of runs of main().
+    if rng is None:
+        rng = np.random.default_rng()
+    if arrivals is None:
+        arrivals = generate_arrival_streams(roads, max_time, rush_hour, rng)
+    if orange_time <= 0:
+        raise ValueError('The hybrid engine hands over during the orange light, orange_time must be positive')
+
+    green_times = light_times[:4]
+    windows, cycle_time = get_green_windows(light_policy, green_times, orange_time)
+    source = SharedCursorArrivals(arrivals.cursor(), arrivals.max_time, arrivals.rush_hour)
+    report = {'fluid_cycles': 0, 'fluid_time': 0.0, 'exact_runs': 1}
+
+    # main() starts with light 1 and changes to orange after 20 seconds. Exact runs stop halfway the orange light before
+    # light 1.
+    first_boundary = 20 + cycle_time - green_times[0]
+    if first_boundary + cycle_time >= max_time:
+        return main(light_policy, max_time, roads, rush_hour, flow_cars, flow_first_car, orange_time,
+                    light_times=light_times, verbose=0, rng=rng, arrivals=arrivals) + (report,)
+    snapshot = HandoverSnapshot.of(main(light_policy, first_boundary - orange_time / 2, roads, rush_hour, flow_cars,
+                                        flow_first_car, orange_time, light_times=light_times, verbose=0, rng=rng,
+                                        arrivals=source, return_snapshot=True))
+
+    # Between exact runs the fluid cycles keep the carried queues in queues, while snapshot is None
+    queues = None
+    exact_cycles = stretch = 1
+    while True:
+        if queues is None:
+            cursor, variates, metrics = snapshot.arrival_cursor, snapshot.variates, snapshot.metrics
+            totals = [snapshot.totals[0], snapshot.totals[1], snapshot.totals[2], snapshot.totals[3]]
+            pending, departures, boundary = get_handover(snapshot, green_times[0])
+            start = snapshot.get_clock()
+            if boundary is None or any(snapshot.states.get_road_length(road) > max_queue for road in roads):
+                lane_queues = None
+            else:
+                lane_queues = {road: list(snapshot.states.get_road_state(road)) for road in roads}
+        else:
+            departures, start, lane_queues = {}, boundary, queues
+
+        # The cycles that end before max_time, at most stretch of them
+        n_cycles = 0
+        while boundary is not None and n_cycles < stretch and boundary + (n_cycles + 1) * cycle_time < max_time:
+            n_cycles += 1
+        accepted, results = 0, None
+        if n_cycles and lane_queues is not None:
+            accepted, results = fluid_cycles(lane_queues, pending, departures, cursor, start, boundary, n_cycles,
+                                             windows, cycle_time, orange_time, flow_cars, flow_first_car, max_queue,
+                                             variates)
+
+        if accepted:
+            for road, (waits, carried, longest, _) in results.items():
+                metrics.record_waits(road, waits)
+                metrics.record_queue(road, longest)
+                wait_time = sum(waits)
+                totals[0] += wait_time
+                totals[1] += len(waits)
+                totals[2][road] += wait_time
+                totals[3][road] += len(waits)
+            queues = {road: carried for road, (_, carried, _, _) in results.items()}
+            end = boundary + accepted * cycle_time
+            metrics.record_stretch(end, sum(area for _, _, _, area in results.values()),
+                                   sum(len(carried) for carried in queues.values()))
+            snapshot = None
+            report['fluid_cycles'] += accepted
+            report['fluid_time'] += end - start
+            boundary = end
+            exact_cycles = 1
+            if accepted == n_cycles:
+                stretch = min(2 * stretch, max_fluid_cycles)
+                continue
+
+        # The next cycle is too busy, or the run is in its last cycle
+        stretch = 1
+        if queues is not None:
+            snapshot = exact_snapshot(light_policy, roads, boundary, queues, pending, cursor, variates, metrics,
+                                      tuple(totals), green_times, flow_first_car)
+            queues = None
+        if boundary is not None:
+            stop = boundary + exact_cycles * cycle_time - orange_time / 2
+        else:
+            stop = snapshot.get_clock() + exact_cycles * cycle_time
+
+        report['exact_runs'] += 1
+        if stop + orange_time >= max_time:
+            return main(light_policy, max_time, roads, rush_hour, flow_cars, flow_first_car, orange_time,
+                        light_times=light_times, verbose=0, snapshot=snapshot) + (report,)
+        snapshot = HandoverSnapshot.of(main(light_policy, stop, roads, rush_hour, flow_cars, flow_first_car,
+                                            orange_time, light_times=light_times, verbose=0, snapshot=snapshot,
+                                            return_snapshot=True))
+        exact_cycles = min(2 * exact_cycles, max_exact_cycles)
+
+
+def compare_hybrid(light_policy, max_time, roads, rush_hour, arrivals_list, light_times=[40, 30, 20, 60],
+                   orange_time=4, max_queue=10, seed=None):
+    # Runs main() and main_hybrid() on the same arrivals, one run per entry of arrivals_list, and reports the mean
+    # average wait of both, the mean difference with the half width of its 95% t confidence interval and the run times
+    seed_sequence = np.random.SeedSequence(seed)
+    exact_waits, hybrid_waits = [], []
+    exact_time = hybrid_time = fluid_time = 0.0
+    for arrivals, replication_seed in zip(arrivals_list, seed_sequence.spawn(len(arrivals_list))):
+        start = t.perf_counter()
+        average_wait, _, _ = main(light_policy, max_time, roads, rush_hour, orange_time=orange_time,
+                                  light_times=light_times, verbose=0, rng=np.random.default_rng(replication_seed),
+                                  arrivals=arrivals)
+        exact_time += t.perf_counter() - start
+        exact_waits.append(average_wait)
+
+        start = t.perf_counter()
+        average_wait, _, _, report = main_hybrid(light_policy, max_time, roads, rush_hour, orange_time=orange_time,
+                                                 light_times=light_times, rng=np.random.default_rng(replication_seed),
+                                                 arrivals=arrivals, max_queue=max_queue)
+        hybrid_time += t.perf_counter() - start
+        hybrid_waits.append(average_wait)
+        fluid_time += report['fluid_time']
+
+    difference, half_width = confidence_interval(np.array(hybrid_waits) - np.array(exact_waits))
+    return {'exact_wait': float(np.mean(exact_waits)), 'hybrid_wait': float(np.mean(hybrid_waits)),
+            'difference': float(difference), 'half_width': float(half_width), 'exact_time': exact_time,
+            'hybrid_time': hybrid_time, 'fluid_share': fluid_time / (max_time * len(arrivals_list))}
@@ -0,0 +1,74 @@
+import time as t
+
+
+class Instrumentation:
+    # Counts of the events processed by main() per type and the time spent on them. The time of an event is split in
+    # the time taken to get it from the future event list and the time its handler takes, drawing random numbers
+    # included. With sample_every=n only every n-th event is timed, the totals are then estimated from the sample.
+    # Hooks are called after every event as hook(type_event, event, states, scheduled_events).
+    def __init__(self, timing=True, sample_every=1, hooks=None):
+        self.timing = timing
+        self.sample_every = sample_every
+        self.hooks = list(hooks) if hooks is not None else []
+        self.num_events = 0
+        self.counts = {}
+        self.timed_counts = {}
+        self.event_list_time = {}
+        self.handler_time = {}
+        self.max_pending_events = 0
+        self.max_cars = 0
+        self.sampled = False
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def start_event(self):
+        # Start time of the event if it is timed, None otherwise
+        self.sampled = self.timing and self.num_events % self.sample_every == 0
+        if self.sampled:
+            return t.perf_counter()
+        return None
+
+    def clock(self):
+        if self.sampled:
+            return t.perf_counter()
+        return None
+
+    def end_event(self, type_event, event, states, scheduled_events, event_start, handler_start):
+        if self.sampled:
+            end = t.perf_counter()
+            self.event_list_time[type_event] = self.event_list_time.get(type_event, 0.0) + handler_start - event_start
+            self.handler_time[type_event] = self.handler_time.get(type_event, 0.0) + end - handler_start
+            self.timed_counts[type_event] = self.timed_counts.get(type_event, 0) + 1
+
+        self.num_events += 1
+        self.counts[type_event] = self.counts.get(type_event, 0) + 1
+        pending = scheduled_events.get_num_events()
+        if pending > self.max_pending_events:
+            self.max_pending_events = pending
+        cars = states.get_total_cars()
+        if cars > self.max_cars:
+            self.max_cars = cars
+
+        for hook in self.hooks:
+            hook(type_event, event, states, scheduled_events)
+
+    def get_summary(self):
+        # Per event type the number of events and the (estimated) total seconds spent in the future event list and in
+        # the handler
+        summary = {}
+        for type_event, count in self.counts.items():
+            timed = self.timed_counts.get(type_event, 0)
+            scale = count / timed if timed else 0.0
+            summary[type_event] = {'count': count,
+                                   'event_list_time': self.event_list_time.get(type_event, 0.0) * scale,
+                                   'handler_time': self.handler_time.get(type_event, 0.0) * scale}
+        return summary
+
+    def report(self):
+        lines = ['{} events, at most {} pending events and {} cars in the system'.format(
+            self.num_events, self.max_pending_events, self.max_cars)]
+        for type_event, row in sorted(self.get_summary().items()):
+            lines.append('{}: {} events, {:.3f} s event list, {:.3f} s handler'.format(
+                type_event, row['count'], row['event_list_time'], row['handler_time']))
+        return '\n'.join(lines)
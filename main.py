@@ -1,34 +1,80 @@
-from engine import SimulationStates, ScheduledEvents, draw_exponential
+from arrivals import generate_arrival_streams
+from cache import ResultCache, canonical_key
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from controllers import FixedTimeController, RatioController
+from engine import SimulationStates, ScheduledEvents, get_lane
+from estimation import confidence_interval
+from event_trace import PrintTrace, ARRIVAL_PASS, ARRIVAL_QUEUE, DEPARTURE, ORANGE_DEPARTURE, ORANGE_STOP, \
+    LIGHT_CHANGE
+from metrics import SimulationMetrics
+from sketch import merge_histograms, road_quantiles
+from snapshot import Snapshot
+from variates import RandomVariates
 import time as t
+import math
+import os
 import numpy as np
 
 
-def init_simulation(policy, scheduled_events, roads, light_time, start_light, flow_first_car):
+def init_simulation(policy, scheduled_events, roads, light_time, start_light, flow_first_car, variates,
+                    arrivals=None):
     # Schedule arrivals on each road
     for road, params in roads.items():
-        time = -0.5 + params[0] * np.random.beta(params[1], params[2])
+        if arrivals is None:
+            time = -0.5 + params[0] * variates.beta(road)
+        else:
+            time = arrivals.next(road)
+            if time is None:
+                continue
         scheduled_events.schedule_arrival(time, road)
 
     # Start departure of first car
     for road in policy[start_light]:
-        time = draw_exponential(flow_first_car)
+        time = variates.exponential(road, flow_first_car)
         scheduled_events.schedule_departure(time, road)
 
     # Schedule orange light
     scheduled_events.schedule_light_change(20, 5)
 
-    # Sort arrivals and departures such that the earliest event is always taken first
-    scheduled_events.sort_arrivals()
-    scheduled_events.sort_departures()
-
     return scheduled_events
 
 
 def main(light_policy, max_time, roads, rush_hour, flow_cars=2, flow_first_car=8,
-         orange_time=1, starting_policy=1, light_times=[40, 30, 20, 60], verbose=1, smart=False):
-
-    # Initialise metrics
-    num_cars_in_system = []
+         orange_time=1, starting_policy=1, light_times=[40, 30, 20, 60], verbose=1, smart=False, rng=None,
+         bucket_width=None, keep_trace=False, arrivals=None, instrument=None, tracer=None, snapshot=None,
+         return_snapshot=False, controller=None):
+
+    # Events are recorded by the tracer, a TraceRecorder for a binary trace. With verbose=1 and no tracer they are
+    # printed.
+    if tracer is None and verbose == 1:
+        tracer = PrintTrace()
+
+    # A run can continue from a Snapshot, with the random numbers of the snapshot or, if rng is given, new ones. The
+    # light_times, smart setting and controller can differ from the run that made the snapshot.
+    if snapshot is not None:
+        if arrivals is not None:
+            raise ValueError('A run from a snapshot continues the arrival streams of the snapshot')
+        snapshot = snapshot.copy()
+        variates = snapshot.variates if rng is None else RandomVariates(rng, roads)
+    else:
+        # All random numbers are drawn in blocks from the given numpy Generator, or from a freshly seeded one
+        if rng is None:
+            rng = np.random.default_rng()
+        variates = RandomVariates(rng, roads)
+
+    # Pre-generated ArrivalStreams replace the arrival draws, they must cover the whole run
+    arrival_cursor = None
+    if snapshot is not None:
+        arrival_cursor = snapshot.arrival_cursor
+    elif arrivals is not None:
+        # Arrivals from detector logs have no rush_hour, the rush hours are in the data
+        if arrivals.max_time < max_time or (arrivals.rush_hour is not None and
+                                            list(arrivals.rush_hour) != list(rush_hour)):
+            raise ValueError('Arrival streams do not match max_time and rush_hour of the simulation')
+        arrival_cursor = arrivals.cursor()
+
+    # Initialise metrics, the number of cars in the system is only kept per event if keep_trace is set
+    metrics = SimulationMetrics(roads, max_time, bucket_width=bucket_width, keep_trace=keep_trace)
     total_wait_time = 0
     total_cars = 0
     road_specific_wait = {'NL': 0, 'NS': 0, 'ES': 0, 'EL': 0, 'SS': 0, 'SL': 0, 'WS': 0, 'WL': 0}
@@ -38,27 +84,49 @@ def main(light_policy, max_time, roads, rush_hour, flow_cars=2, flow_first_car=8
     mid_rush1 = rush_hour[0] + (rush_hour[1] - rush_hour[0]) / 2
     mid_rush2 = rush_hour[2] + (rush_hour[3] - rush_hour[2]) / 2
 
-    # Calculate total seconds of light time
-    total_seconds = sum(light_times)
+    # The controller decides the lights, by default the fixed time controller or with smart the ratio based one
+    if controller is None:
+        if smart:
+            controller = RatioController(light_policy, light_times)
+        else:
+            controller = FixedTimeController(light_policy, light_times)
+
+    if snapshot is not None:
+        # Continue with the engines, metrics and totals of the snapshot
+        states = snapshot.states
+        scheduled_events = snapshot.scheduled_events
+        metrics = snapshot.metrics
+        metrics.extend(max_time)
+        total_wait_time, total_cars, road_specific_wait, road_specific_cars = snapshot.totals
+        new_time = states.get_clock()
+    else:
+        # Initialise the simulation engines
+        states = SimulationStates(light_policy=light_policy)
+        scheduled_events = ScheduledEvents()
 
-    # Initialise the simulation engines
-    states = SimulationStates()
-    scheduled_events = ScheduledEvents()
+        # Initialise the traffic lights to the starting lights
+        states.change_lights(starting_policy)
 
-    # Initialise the traffic lights to the starting lights
-    states.change_lights(starting_policy)
+        # Define a new time variable that will help us check if simulation runs properly by checking if time is
+        # running smoothly (not going backwards)
+        new_time = 0
 
-    # Define a new time variable that will help us check if simulation runs properly by checking if time is running
-    # smoothly (not going backwards)
-    new_time = 0
+        # Initialise the first arrivals, departures (at road that is open/green) and light change
+        scheduled_events = init_simulation(light_policy, scheduled_events, roads, light_times[starting_policy - 1],
+                                           start_light=starting_policy, flow_first_car=flow_first_car,
+                                           variates=variates, arrivals=arrival_cursor)
 
-    # Initialise the first arrivals, departures (at road that is open/green) and light change
-    scheduled_events = init_simulation(light_policy, scheduled_events, roads, light_times[starting_policy - 1],
-                                       start_light=starting_policy, flow_first_car=flow_first_car)
+    # An Instrumentation counts and times the events and calls its hooks, with None the loop only pays for the checks
+    event_start = handler_start = None
 
     while states.get_clock() < max_time:
+        if instrument is not None:
+            event_start = instrument.start_event()
+
         # Get event with lowest scheduled time from all events and process it
         event, type_event = scheduled_events.get_next_event()
+        if instrument is not None:
+            handler_start = instrument.clock()
 
         # Create list with roads where light is green
         open_roads = light_policy[states.get_light_state()]
@@ -76,39 +144,39 @@ def main(light_policy, max_time, roads, rush_hour, flow_cars=2, flow_first_car=8
             c_time = states.get_clock()
 
             # If the road is on green and the road is empty the car passes through and a new arrival is scheduled
-            if event[1] in open_roads and not states.get_road_state(event[1]):
+            if event[1] in open_roads and not states.get_road_length(event[1]):
 
-                if verbose == 1:
-                    print('Type event: {} at road {} at time {}'.format(type_event, event[1], event[0]))
-                    print('There is an open road and light is on green, the car just passes through.')
+                if tracer is not None:
+                    tracer.record(event[0], ARRIVAL_PASS, get_lane(event[1]), states.get_light_state(), 0)
 
             # If not open and empty we enqueue a car at our road and note the current time
             else:
-                if verbose == 1:
-                    print('Type event: {} at road {} at time {}'.format(type_event, event[1], event[0]))
-
                 states.enqueue(event[1], event[0])
+                metrics.record_queue(event[1], states.get_road_length(event[1]))
+
+                if tracer is not None:
+                    tracer.record(event[0], ARRIVAL_QUEUE, get_lane(event[1]), states.get_light_state(),
+                                  states.get_road_length(event[1]))
 
             # Generate a new arrival with rate passed in simulation. It checks if it is rush hour and multiplies the
             # rate of arrival by 2 at peak rush hours, with the multiplier decreasing linearly as it is further from
             # peak rush hour
 
             gen_param = roads[event[1]]
-            if rush_hour[0] < c_time < rush_hour[1]:
+            if arrival_cursor is not None:
+                # The streams end with the first arrival after max_time, the simulation stops before it is needed
+                time = arrival_cursor.next(event[1])
+            elif rush_hour[0] < c_time < rush_hour[1]:
                 multiplier = 2 - (abs(c_time - mid_rush1) / (2 * 60 * 60))
-                time = min(-0.5 + gen_param[0] / multiplier * np.random.beta(gen_param[1],
-                                                                         gen_param[2]), 1) + states.get_clock()
+                time = min(-0.5 + gen_param[0] / multiplier * variates.beta(event[1]), 1) + states.get_clock()
             elif rush_hour[2] < c_time < rush_hour[3]:
                 multiplier = 2 - (abs(c_time - mid_rush2) / (2 * 60 * 60))
-                time = min(-0.5 + gen_param[0] / multiplier * np.random.beta(gen_param[1],
-                                                                         gen_param[2]), 1) + states.get_clock()
+                time = min(-0.5 + gen_param[0] / multiplier * variates.beta(event[1]), 1) + states.get_clock()
             else:
-                time = min(-0.5 + gen_param[0] * np.random.beta(gen_param[1], gen_param[2]), 1) + states.get_clock()
-
-            scheduled_events.schedule_arrival(time, event[1])
+                time = min(-0.5 + gen_param[0] * variates.beta(event[1]), 1) + states.get_clock()
 
-            # Sort arrivals to ensure newest arrival is first
-            scheduled_events.sort_arrivals()
+            if time is not None:
+                scheduled_events.schedule_arrival(time, event[1])
 
         # Process departures
         if type_event == 'departure':
@@ -121,66 +189,63 @@ def main(light_policy, max_time, roads, rush_hour, flow_cars=2, flow_first_car=8
             states.advance_clock(time_departure)
 
             # Checks if road has cars in it, if not new departure
-            if states.get_road_state(road) and road in light_policy[states.get_light_state()]:
-                if verbose == 1:
-                    print('Type event: {} at road {} at time {}'.format(type_event, road, time_departure))
-
+            if states.get_road_length(road) and road in light_policy[states.get_light_state()]:
                 # Do the departure
                 time_departure = states.departure(road)
 
-                # If we use smart lights we instantly switch to orange if both roads are empty
-                if smart:
-                    empty = False
-                    for open_road in policies[states.get_light_state()]:
-                        if not states.get_road_state(open_road):
-                            empty = True
-                    if empty:
-                        scheduled_events.clear_light_change()
-                        scheduled_events.schedule_light_change(states.get_clock(), 5)
-
+                if tracer is not None:
+                    tracer.record(states.get_clock(), DEPARTURE, get_lane(road), states.get_light_state(),
+                                  states.get_road_length(road), states.get_clock() - time_departure)
 
+                # The controller can end the green light early, then the pending light change is cancelled and the
+                # light switches to orange right away
+                if controller.end_green(states, states.get_light_state()):
+                    scheduled_events.clear_light_change()
+                    scheduled_events.schedule_light_change(states.get_clock(), 5)
 
                 # Update metrics
                 total_wait_time += states.get_clock() - time_departure
                 total_cars += 1
                 road_specific_wait[road] += states.get_clock() - time_departure
                 road_specific_cars[road] += 1
+                metrics.record_wait(road, states.get_clock() - time_departure)
 
                 # Schedule new departure with lower flow rate than first departure, to simulate multiple cars following
                 # closely together
-                time = draw_exponential(flow_cars) + states.get_clock()
+                time = variates.exponential(road, flow_cars) + states.get_clock()
                 scheduled_events.schedule_departure(time, road)
 
             # Check if light is orange and there are cars on the road
-            elif states.get_road_state(road) and states.get_light_state() == 5:
+            elif states.get_road_length(road) and states.get_light_state() == 5:
 
                 # Get time light has been on orange
                 time_since_orange = states.get_clock() - states.get_time_last_orange()
 
                 # Make car go through orange with probability based on the time the light has been on orange, low orange
                 # time means high chance of passing through
-                draw = np.random.uniform()
+                draw = variates.uniform()
                 if draw > (time_since_orange / orange_time):
-                    if verbose == 1:
-                        print('Passing through orange!')
-                        print('Type event: {} at road {} at time {}'.format(type_event, road, time_departure))
-
                     # Do departure
                     time_departure = states.departure(road)
 
+                    if tracer is not None:
+                        tracer.record(states.get_clock(), ORANGE_DEPARTURE, get_lane(road), states.get_light_state(),
+                                      states.get_road_length(road), states.get_clock() - time_departure)
+
                     # Update metrics
                     total_wait_time += states.get_clock() - time_departure
                     total_cars += 1
                     road_specific_wait[road] += states.get_clock() - time_departure
                     road_specific_cars[road] += 1
+                    metrics.record_wait(road, states.get_clock() - time_departure)
 
                     # Schedule new departure
-                    time = draw_exponential(flow_cars) + states.get_clock()
+                    time = variates.exponential(road, flow_cars) + states.get_clock()
                     scheduled_events.schedule_departure(time, road)
 
-                elif verbose == 1:
-                    print('Stopped at orange!')
-                    print('Type event: {} at road {} at time {}'.format(type_event, road, time_departure))
+                elif tracer is not None:
+                    tracer.record(time_departure, ORANGE_STOP, get_lane(road), states.get_light_state(),
+                                  states.get_road_length(road))
 
         # Handle lights change
         if type_event == 'light_change':
@@ -191,78 +256,49 @@ def main(light_policy, max_time, roads, rush_hour, flow_cars=2, flow_first_car=8
             new_light = event[1]
             old_light = states.get_light_state()
 
-            # If new light is orange, schedule the next non orange light quickly
+            # If new light is orange, the controller picks the green light that comes after it
             if new_light == 5:
-                if verbose == 1:
-                    print('Type event: {} to light state {} at time {}'.format(type_event, event[1], event[0]))
-
-                if old_light // 4 == 1:
-                    states.change_lights(new_light)
-                    scheduled_events.schedule_light_change(orange_time + states.get_clock(), 1)
-                else:
-                    states.change_lights(new_light)
-                    scheduled_events.schedule_light_change(orange_time + states.get_clock(), old_light + 1)
+                states.change_lights(new_light)
+                scheduled_events.schedule_light_change(orange_time + states.get_clock(),
+                                                       controller.get_next_light(states, old_light))
 
-            # If the new light is not orange schedule the next orange light based on given light times
+            # If the new light is not orange the controller decides how long it stays on
             else:
-                if smart:
-                    states.change_lights(new_light)
-                    if verbose == 1:
-                        print('Type event: {} to light state {} at time {}'.format(type_event,
-                                                                                   states.get_light_state(),event[0]))
-                    empty = True
-                    total_cars_open = 0
-
-                    # Check if the current open roads all are empty and schedule a new road light instantly
-                    for open_road in policies[states.get_light_state()]:
-                        total_cars_open += len(states.get_road_state(open_road))
-                        if open_road:
-                            empty = False
-
-                    # Check if all roads are empty, if they are schedule new light 10 seconds from now to prevent rapid
-                    # switching between lights.
-                    all_empty = states.all_roads_empty()
-                    if empty and not all_empty:
-                        scheduled_events.schedule_light_change(states.get_clock(), 5)
-
-                    elif empty and all_empty:
-                        scheduled_events.schedule_light_change(states.get_clock()+10, 5)
-
-                    else:
-                        # Calculate the ratio of cars that are in this traffic light, if it is high increase time this
-                        # Light stays open
-                        total_cars_system = states.get_total_cars()
-                        ratio = total_cars_open / total_cars_system
-
-                        # Extra time is based on total amount of seconds lights stay open in 'dumb'
-                        time = states.get_clock() + total_seconds * ratio
-                        scheduled_events.schedule_light_change(time, 5)
-
-                else:
-                    states.change_lights(new_light)
-                    if verbose == 1:
-                        print('Type event: {} to light state {} at time {}'.format(type_event, event[1], event[0]))
-
-                    scheduled_events.schedule_light_change(light_times[new_light - 1] + states.get_clock(), 5)
+                states.change_lights(new_light)
+                scheduled_events.schedule_light_change(states.get_clock() +
+                                                       controller.get_green_time(states, new_light), 5)
 
                 for road in light_policy[new_light]:
-                    time = draw_exponential(flow_first_car) + states.get_clock()
+                    time = variates.exponential(road, flow_first_car) + states.get_clock()
                     scheduled_events.schedule_departure(time, road)
-                    scheduled_events.sort_departures()
+
+            if tracer is not None:
+                tracer.record(event[0], LIGHT_CHANGE, -1, new_light, states.get_total_cars())
 
         # Update new time after event
         new_time = states.get_clock()
 
-        # Add an entry for the total number of cars in the system
-        num_cars_in_system.append(states.get_total_cars())
+        # Update the number of cars in the system
+        metrics.record_event(new_time, states.get_total_cars())
+        if instrument is not None:
+            instrument.end_event(type_event, event, states, scheduled_events, event_start, handler_start)
+
+    # Stop here to continue later, the cars in the queues have not left yet
+    if return_snapshot:
+        return Snapshot(states, scheduled_events, variates, arrival_cursor, metrics,
+                        (total_wait_time, total_cars, road_specific_wait, road_specific_cars))
 
     # Count the amount of time the cars that are still in the queue after the end of the simulation have waited
+    left_waits = {}
     road_specific_wait, road_specific_cars, left_wait_time, left_cars = \
-        states.get_wait_time_per_road(road_specific_wait, road_specific_cars)
+        states.get_wait_time_per_road(road_specific_wait, road_specific_cars, left_waits)
+    for road, waits in left_waits.items():
+        metrics.record_waits(road, waits)
 
     # Update metrics
     total_wait_time += left_wait_time
     total_cars += left_cars
+    metrics.finish(road_specific_wait, road_specific_cars)
 
     # Create average waited time per road
     try:
@@ -270,22 +306,189 @@ def main(light_policy, max_time, roads, rush_hour, flow_cars=2, flow_first_car=8
     except ZeroDivisionError:
         average_wait_per_road = None
 
-    return total_wait_time / total_cars, average_wait_per_road, num_cars_in_system
+    return total_wait_time / total_cars, average_wait_per_road, metrics
+
+
+def replication_seed(seed, replication):
+    # The random stream of a replication only depends on the master seed and the number of the replication, so it is
+    # the same whether the replication runs serially or in any worker process
+    return np.random.SeedSequence(seed, spawn_key=(replication,))
+
 
+def arrival_seed(seed, replication):
+    # Separate stream for the arrivals of a replication, so they stay the same whatever happens at the lights
+    return np.random.SeedSequence(seed, spawn_key=(replication, 0))
 
-def test_light_schedule(policy, schedules, n_simulations, time_horizon, road_list, rush_hours):
+
+def run_chunk(policy, time_horizon, road_list, rush_hours, seed, chunk, common_arrivals=False, cache_path=None,
+              keep_waits=False, max_entries=100000):
+    # Run a chunk of (index, (schedule, replication)) tasks and return (index, result) pairs. With common_arrivals all
+    # schedules of a replication get the same arrival streams, which are generated once per replication in the chunk.
+    # With a cache_path results that are already in the ResultCache are not simulated again. With keep_waits a result
+    # also has the LogHistogram of the waits per road, the cache only has the means so it is not used then. The cache
+    # keeps at most about max_entries results.
+    cache = None if cache_path is None or keep_waits else ResultCache(cache_path, max_entries)
     results = []
-    for schedule in schedules:
-        print('Testing light times: {}'.format(schedule))
-        total_sim_av_time = 0
-        for i in range(n_simulations):
-            print('Starting simulation {}/{}'.format(i+1, n_simulations))
-            average_wait_time, _, _ = main(policy, time_horizon, road_list, rush_hours,
-                                           orange_time=4, light_times=schedule, verbose=0, smart=schedule[-1])
-            total_sim_av_time += average_wait_time
+    arrival_streams = {}
+    for index, (schedule, replication) in chunk:
+        key = None
+        if cache is not None:
+            key = canonical_key(light_policy=policy, max_time=time_horizon, roads=road_list, rush_hour=rush_hours,
+                                flow_cars=2, flow_first_car=8, orange_time=4, light_times=schedule[:4],
+                                smart=schedule[-1], seed=[seed, replication, common_arrivals])
+            cached = cache.get(key)
+            if cached is not None:
+                results.append((index, cached))
+                continue
+
+        rng = np.random.default_rng(replication_seed(seed, replication))
+        arrivals = None
+        if common_arrivals:
+            if replication not in arrival_streams:
+                arrival_streams[replication] = generate_arrival_streams(
+                    road_list, time_horizon, rush_hours, np.random.default_rng(arrival_seed(seed, replication)))
+            arrivals = arrival_streams[replication]
+        average_wait_time, average_wait_per_road, metrics = main(policy, time_horizon, road_list, rush_hours,
+                                                                 orange_time=4, light_times=schedule, verbose=0,
+                                                                 smart=schedule[-1], rng=rng, arrivals=arrivals)
+        if keep_waits:
+            results.append((index, (average_wait_time, average_wait_per_road, metrics.road_waits)))
+            continue
+        if cache is not None:
+            cache.put(key, average_wait_time, average_wait_per_road)
+        results.append((index, (average_wait_time, average_wait_per_road)))
+
+    if cache is not None:
+        cache.close()
+    return results
+
+
+def run_parallel(policy, time_horizon, road_list, rush_hours, tasks, seed, n_workers=None, chunksize=None,
+                 common_arrivals=False, cache_path=None, keep_waits=False, max_entries=100000):
+    # Spread the tasks over a process pool in chunks and collect the results as they finish. The results are returned
+    # in the order of the tasks. With n_workers=1 everything runs in the current process.
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    if chunksize is None:
+        chunksize = max(1, math.ceil(len(tasks) / (4 * n_workers)))
+    indexed_tasks = list(enumerate(tasks))
+    chunks = [indexed_tasks[i:i + chunksize] for i in range(0, len(tasks), chunksize)]
+
+    results = [None] * len(tasks)
+    if n_workers == 1:
+        for chunk in chunks:
+            for index, result in run_chunk(policy, time_horizon, road_list, rush_hours, seed, chunk, common_arrivals,
+                                             cache_path, keep_waits, max_entries):
+                results[index] = result
+        return results
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(run_chunk, policy, time_horizon, road_list, rush_hours, seed, chunk,
+                                   common_arrivals, cache_path, keep_waits, max_entries)
+                   for chunk in chunks]
+        for future in as_completed(futures):
+            for index, result in future.result():
+                results[index] = result
+    return results
+
+
+def test_light_schedule(policy, schedules, n_simulations, time_horizon, road_list, rush_hours, seed=None,
+                        n_workers=None, chunksize=None, common_arrivals=True, cache_path=None, max_entries=100000):
+    # Use a fresh master seed if none is given, print it so the sweep can be reproduced
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+        print('Master seed: {}'.format(seed))
+
+    # The schedules of a replication are next to each other, so with common arrivals a chunk of whole replications
+    # only generates the arrival streams once per replication
+    tasks = [(schedule, i) for i in range(n_simulations) for schedule in schedules]
+    if common_arrivals and chunksize is None:
+        workers = os.cpu_count() if n_workers is None else n_workers
+        chunksize = len(schedules) * max(1, math.ceil(n_simulations / (4 * workers)))
+    results_tasks = run_parallel(policy, time_horizon, road_list, rush_hours, tasks, seed, n_workers, chunksize,
+                                 common_arrivals, cache_path, max_entries=max_entries)
 
+    results = []
+    for j, schedule in enumerate(schedules):
+        replications = results_tasks[j::len(schedules)]
+        total_sim_av_time = sum(average_wait_time for average_wait_time, _ in replications)
+        print('Light times: {}, average wait time: {}'.format(schedule, total_sim_av_time / n_simulations))
         results.append(total_sim_av_time / n_simulations)
     print(results)
+    return results
+
+
+def wait_distribution(policy, schedules, n_simulations, time_horizon, road_list, rush_hours, qs=(0.5, 0.9, 0.99),
+                      seed=None, n_workers=None, common_arrivals=True):
+    # Quantiles of the wait of all cars of n_simulations replications per schedule, overall and per road. The workers
+    # only send back the wait histograms of their replications, which are merged here.
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+        print('Master seed: {}'.format(seed))
+
+    tasks = [(schedule, i) for i in range(n_simulations) for schedule in schedules]
+    results_tasks = run_parallel(policy, time_horizon, road_list, rush_hours, tasks, seed, n_workers,
+                                 common_arrivals=common_arrivals, keep_waits=True)
+
+    results = []
+    for j, schedule in enumerate(schedules):
+        road_waits = [road_wait for _, _, road_wait in results_tasks[j::len(schedules)]]
+        merged = {road: merge_histograms(waits[road] for waits in road_waits) for road in road_waits[0]}
+        quantiles = road_quantiles(merged, qs)
+        print('Light times: {}, wait quantiles: {}'.format(schedule, quantiles['all']))
+        results.append(quantiles)
+    return results
+
+
+def test_light_schedule_sequential(policy, schedules, time_horizon, road_list, rush_hours, relative_precision=0.05,
+                                   confidence=0.95, pilot=5, batch=10, max_replications=100, budget=None, seed=None,
+                                   n_workers=None, common_arrivals=True, cache_path=None):
+    # Run a pilot of replications per schedule, then keep adding replications to the schedules whose confidence
+    # interval of the mean average wait is wider than relative_precision times the mean. A schedule gets at most
+    # max_replications and all schedules together at most budget replications. Every round runs the new replications
+    # of all schedules in parallel. Replication i of every schedule uses the same random numbers.
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+        print('Master seed: {}'.format(seed))
+    if budget is None:
+        budget = max_replications * len(schedules)
+
+    waits = [[] for _ in schedules]
+    wanted = [min(pilot, max_replications) for _ in schedules]
+    used = 0
+    while True:
+        tasks = []
+        owners = []
+        for j, schedule in enumerate(schedules):
+            extra = max(min(wanted[j] - len(waits[j]), budget - used - len(tasks)), 0)
+            tasks.extend((schedule, i) for i in range(len(waits[j]), len(waits[j]) + extra))
+            owners.extend([j] * extra)
+        if not tasks:
+            break
+        used += len(tasks)
+
+        results_tasks = run_parallel(policy, time_horizon, road_list, rush_hours, tasks, seed, n_workers,
+                                     common_arrivals=common_arrivals, cache_path=cache_path)
+        for j, (average_wait_time, _) in zip(owners, results_tasks):
+            waits[j].append(average_wait_time)
+
+        # Ask for enough replications to reach the precision if the standard deviation stays the same, at most batch
+        # more per round
+        for j in range(len(schedules)):
+            mean, half_width = confidence_interval(waits[j], confidence)
+            if half_width > relative_precision * abs(mean) and len(waits[j]) < max_replications:
+                needed = math.ceil(len(waits[j]) * (half_width / (relative_precision * abs(mean))) ** 2)
+                wanted[j] = min(max_replications, len(waits[j]) + min(max(needed - len(waits[j]), 1), batch))
+
+    results = []
+    for schedule, schedule_waits in zip(schedules, waits):
+        mean, half_width = confidence_interval(schedule_waits, confidence)
+        converged = half_width <= relative_precision * abs(mean)
+        print('Light times: {}, average wait time: {} +- {} ({} replications{})'.format(
+            schedule, mean, half_width, len(schedule_waits), '' if converged else ', not converged'))
+        results.append({'schedule': schedule, 'mean': mean, 'half_width': half_width,
+                        'replications': len(schedule_waits), 'converged': converged})
+    return results
 
 
 # Press the green button in the gutter to run the script.
@@ -0,0 +1,164 @@
+from sketch import LogHistogram, merge_histograms, road_quantiles
+import math
+
+import numpy as np
+
+
+class SimulationMetrics:
+    # Keeps running totals of the number of cars in the system instead of a list with an entry per event, so memory does
+    # not grow with the time horizon. The number of cars is integrated over time between events for time weighted
+    # averages. Optionally the average number of cars per bucket of bucket_width seconds is kept in a fixed size array
+    # and the full per event trace is kept in a list. A stretch of time can also be recorded at once, with the integral
+    # of the number of cars over it, the time series has no values for it.
+    def __init__(self, roads, max_time, bucket_width=None, keep_trace=False):
+        self.num_events = 0
+        self.start_time = 0.0
+        self.last_time = 0.0
+        self.last_total = 0
+        self.area = 0.0
+        self.max_cars = 0
+        self.road_max = {road: 0 for road in roads}
+        self.road_wait = {road: 0 for road in roads}
+        self.road_cars = {road: 0 for road in roads}
+        # Distribution of the wait of every car per road, the cars still queued at the end included
+        self.road_waits = {road: LogHistogram() for road in roads}
+
+        self.bucket_width = bucket_width
+        if bucket_width is None:
+            self.buckets = None
+            self.stretch_buckets = None
+        else:
+            self.buckets = np.zeros(math.ceil(max_time / bucket_width))
+            self.stretch_buckets = np.zeros(len(self.buckets))
+
+        if keep_trace:
+            self.trace = []
+        else:
+            self.trace = None
+
+    def record_event(self, time, total_cars):
+        # The number of cars did not change between the previous event and this one. Arrivals can be scheduled slightly
+        # before the current clock, time only counts when it moves forward.
+        self.num_events += 1
+        if time > self.last_time:
+            if self.buckets is not None:
+                self.add_to_buckets(self.last_time, time, self.last_total)
+            self.area += self.last_total * (time - self.last_time)
+            self.last_time = time
+
+        self.last_total = total_cars
+        if total_cars > self.max_cars:
+            self.max_cars = total_cars
+        if self.trace is not None:
+            self.trace.append(total_cars)
+
+    def record_stretch(self, time, area, total_cars):
+        # The number of cars between the previous event and time was followed elsewhere, area is its integral over time
+        # and total_cars the number of cars at time. The events and the largest number of cars of the stretch are not
+        # known.
+        if time > self.last_time:
+            if self.buckets is not None:
+                self.add_to_buckets(self.last_time, time, 1, self.stretch_buckets)
+            self.area += area
+            self.last_time = time
+        self.last_total = total_cars
+
+    def reset(self, time):
+        # Start measuring again from time, for runs that continue from a snapshot
+        self.num_events = 0
+        self.start_time = time
+        self.last_time = time
+        self.area = 0.0
+        self.max_cars = self.last_total
+        self.road_max = {road: 0 for road in self.road_max}
+        self.road_wait = {road: 0 for road in self.road_wait}
+        self.road_cars = {road: 0 for road in self.road_cars}
+        self.road_waits = {road: LogHistogram() for road in self.road_waits}
+        if self.buckets is not None:
+            self.buckets[:] = 0
+            self.stretch_buckets[:] = 0
+        if self.trace is not None:
+            self.trace = []
+
+    def extend(self, max_time):
+        # Make room in the buckets for a run that continues up to a later max_time
+        if self.buckets is not None and len(self.buckets) < math.ceil(max_time / self.bucket_width):
+            extra = np.zeros(math.ceil(max_time / self.bucket_width) - len(self.buckets))
+            self.buckets = np.concatenate([self.buckets, extra])
+            self.stretch_buckets = np.concatenate([self.stretch_buckets, extra])
+
+    def get_duration(self):
+        return self.last_time - self.start_time
+
+    def record_queue(self, road, length):
+        if length > self.road_max[road]:
+            self.road_max[road] = length
+
+    def record_wait(self, road, wait):
+        self.road_waits[road].add(wait)
+
+    def record_waits(self, road, waits):
+        self.road_waits[road].add_many(waits)
+
+    def add_to_buckets(self, start, end, cars, buckets=None):
+        # Spread the car seconds between start and end over the buckets they fall in, time past the last bucket is
+        # not kept
+        if buckets is None:
+            buckets = self.buckets
+        bucket = int(start // self.bucket_width)
+        while bucket < len(buckets) and start < end:
+            bucket_end = min((bucket + 1) * self.bucket_width, end)
+            buckets[bucket] += cars * (bucket_end - start)
+            start = bucket_end
+            bucket += 1
+
+    def finish(self, road_specific_wait, road_specific_cars):
+        # Total time waited and number of cars per road, including the cars still in the queue at the end
+        self.road_wait = dict(road_specific_wait)
+        self.road_cars = dict(road_specific_cars)
+
+    def get_num_events(self):
+        return self.num_events
+
+    def get_max_cars(self):
+        return self.max_cars
+
+    def get_average_cars(self):
+        # Time weighted average number of cars in the system
+        if self.get_duration() > 0:
+            return self.area / self.get_duration()
+        return 0.0
+
+    def get_road_statistics(self):
+        # The time weighted average queue length of a road equals the total time waited on that road divided by the
+        # simulated time
+        statistics = {}
+        duration = self.get_duration()
+        for road in self.road_max:
+            statistics[road] = {'max_queue': self.road_max[road],
+                                'average_queue': self.road_wait[road] / duration if duration > 0 else 0.0,
+                                'cars': self.road_cars[road]}
+        return statistics
+
+    def get_wait_histogram(self, road=None):
+        # LogHistogram of the waits of a road or, without a road, of all cars. Histograms of replications can be merged.
+        if road is not None:
+            return self.road_waits[road]
+        return merge_histograms(self.road_waits.values())
+
+    def get_wait_quantiles(self, qs=(0.5, 0.9, 0.99)):
+        # Quantiles of the wait of all cars and per road
+        return road_quantiles(self.road_waits, qs)
+
+    def get_time_series(self):
+        # Average number of cars in the system per bucket over the time that was not recorded as a stretch, NaN for
+        # buckets that are completely in stretches
+        if self.buckets is None:
+            return None
+        starts = np.arange(len(self.buckets)) * self.bucket_width
+        covered = np.clip(np.minimum(starts + self.bucket_width, self.last_time) - np.maximum(starts, self.start_time),
+                          0, self.bucket_width) - self.stretch_buckets
+        series = np.zeros(len(self.buckets))
+        np.divide(self.buckets, covered, out=series, where=covered > 1e-9)
+        series[(covered <= 1e-9) & (self.stretch_buckets > 0)] = np.nan
+        return series
@@ -0,0 +1,487 @@
+from arrivals import NO_RUSH_HOUR, rush_hour_multiplier
+from engine import LANES, LANE_INDEX
+from functools import partial
+from variates import VariateBuffer
+import heapq
+import itertools
+import multiprocessing
+import numpy as np
+
+
+# Kinds of network events, events at the same time are handled departures first, then arrivals, then light changes
+DEPARTURE = 0
+ARRIVAL = 1
+ROUTED_ARRIVAL = 2
+LIGHT_CHANGE = 3
+EVENT_PRIORITY = [0, 1, 1, 2]
+
+# Direction a car is heading when it comes from a side, and the side of the next intersection it arrives from
+HEADING = {'N': 'S', 'E': 'W', 'S': 'N', 'W': 'E'}
+LEFT_OF = {'S': 'E', 'W': 'S', 'N': 'W', 'E': 'N'}
+OPPOSITE = {'N': 'S', 'E': 'W', 'S': 'N', 'W': 'E'}
+STEP = {'N': (-1, 0), 'E': (0, 1), 'S': (1, 0), 'W': (0, -1)}
+
+
+class Network:
+    # Intersections with the eight lanes of main() each, lane l of intersection i is global lane 8 * i + l. Every
+    # intersection has its own light policy, light times, controller and offset of its light cycle. Boundary lanes
+    # get arrivals like main() with the parameters in arrival_params, other lanes have NaN parameters. A car that leaves
+    # lane k goes to one of route_lanes[route_start[k]:route_start[k + 1]], chosen with the cumulative probabilities in
+    # route_cumulative, -1 leaves the network. It arrives there after route_min_time plus an exponential time with mean
+    # route_extra_time.
+    def __init__(self, light_policies, light_times, smart, offsets, arrival_params, route_start, route_lanes,
+                 route_cumulative, route_min_time, route_extra_time, starting_policy=1):
+        self.n_intersections = len(light_policies)
+        self.n_lanes = len(LANES) * self.n_intersections
+
+        # open_lanes[i, light state, lane] is True if the lane of intersection i is green in that light state
+        self.open_lanes = np.zeros((self.n_intersections, 6, len(LANES)), dtype=bool)
+        for i, light_policy in enumerate(light_policies):
+            for light, open_roads in light_policy.items():
+                for road in open_roads:
+                    if road in LANE_INDEX:
+                        self.open_lanes[i, light, LANE_INDEX[road]] = True
+
+        self.light_times = np.asarray(light_times, dtype=float).reshape(self.n_intersections, 4)
+        self.smart = np.asarray(smart, dtype=bool).reshape(self.n_intersections)
+        self.offsets = np.asarray(offsets, dtype=float).reshape(self.n_intersections)
+        self.arrival_params = np.asarray(arrival_params, dtype=float).reshape(self.n_lanes, 3)
+        self.route_start = np.asarray(route_start, dtype=np.int64)
+        self.route_lanes = np.asarray(route_lanes, dtype=np.int64)
+        self.route_cumulative = np.asarray(route_cumulative, dtype=float)
+        self.route_min_time = np.asarray(route_min_time, dtype=float)
+        self.route_extra_time = np.asarray(route_extra_time, dtype=float)
+        self.starting_policy = starting_policy
+
+    def get_min_travel_time(self):
+        # Shortest time between leaving an intersection and arriving at the next one
+        internal = self.route_lanes >= 0
+        return self.route_min_time[internal].min() if internal.any() else np.inf
+
+
+def green_wave_offsets(rows, cols, travel_time):
+    # Offsets that let the lights of every row turn green one travel time after the intersection to the west
+    return [col * travel_time for row in range(rows) for col in range(cols)]
+
+
+def grid_network(rows, cols, roads, light_policy, light_times=[40, 30, 20, 60], smart=False, offsets=None,
+                 p_left=0.2, min_travel_time=10.0, extra_travel_time=5.0):
+    # Manhattan grid of rows x cols intersections that all use light_policy. Straight lanes continue straight and left
+    # lanes turn left. A car that reaches the next intersection takes its left lane with probability p_left. Lanes at
+    # the edge of the grid get the arrivals of roads, cars that drive off the grid leave the network.
+    n_intersections = rows * cols
+    arrival_params = np.full((n_intersections * len(LANES), 3), np.nan)
+    route_start = [0]
+    route_lanes, route_cumulative = [], []
+
+    for row in range(rows):
+        for col in range(cols):
+            for lane, road in enumerate(LANES):
+                side = road[0]
+                heading = HEADING[side] if road[1] == 'S' else LEFT_OF[HEADING[side]]
+                upstream = (row + STEP[side][0], col + STEP[side][1])
+                if not (0 <= upstream[0] < rows and 0 <= upstream[1] < cols):
+                    arrival_params[(row * cols + col) * len(LANES) + lane] = roads[road]
+
+                downstream = (row + STEP[heading][0], col + STEP[heading][1])
+                if 0 <= downstream[0] < rows and 0 <= downstream[1] < cols:
+                    entry = OPPOSITE[heading]
+                    first = (downstream[0] * cols + downstream[1]) * len(LANES)
+                    route_lanes += [first + LANE_INDEX[entry + 'S'], first + LANE_INDEX[entry + 'L']]
+                    route_cumulative += [1 - p_left, 1.0]
+                else:
+                    route_lanes.append(-1)
+                    route_cumulative.append(1.0)
+                route_start.append(len(route_lanes))
+
+    if offsets is None:
+        offsets = np.zeros(n_intersections)
+    n_routes = len(route_lanes)
+    return Network([light_policy] * n_intersections, np.tile(np.asarray(light_times[:4], dtype=float),
+                                                              (n_intersections, 1)),
+                   np.broadcast_to(smart, n_intersections), offsets, arrival_params, route_start, route_lanes,
+                   route_cumulative, np.full(n_routes, min_travel_time), np.full(n_routes, extra_travel_time))
+
+
+class CarPool:
+    # The queues of all lanes of the network. Every queued car is a slot in a few arrays, the cars of a lane form a
+    # linked list from lane_head to lane_tail through car_next. Free slots are a linked list too, the arrays double in
+    # size when they run out.
+    def __init__(self, n_lanes, capacity=4096):
+        self.lane_head = np.full(n_lanes, -1, dtype=np.int64)
+        self.lane_tail = np.full(n_lanes, -1, dtype=np.int64)
+        self.lane_length = np.zeros(n_lanes, dtype=np.int64)
+        self.car_time = np.empty(capacity)
+        self.car_lane = np.full(capacity, -1, dtype=np.int64)
+        self.car_next = np.arange(1, capacity + 1, dtype=np.int64)
+        self.car_next[-1] = -1
+        self.free_head = 0
+
+    def grow(self):
+        capacity = len(self.car_time)
+        self.car_time = np.concatenate([self.car_time, np.empty(capacity)])
+        self.car_lane = np.concatenate([self.car_lane, np.full(capacity, -1, dtype=np.int64)])
+        self.car_next = np.concatenate([self.car_next, np.arange(capacity + 1, 2 * capacity + 1, dtype=np.int64)])
+        self.car_next[-1] = -1
+        self.free_head = capacity
+
+    def enqueue(self, lane, time):
+        if self.free_head == -1:
+            self.grow()
+        car = self.free_head
+        self.free_head = self.car_next.item(car)
+        self.car_time[car] = time
+        self.car_lane[car] = lane
+        self.car_next[car] = -1
+        tail = self.lane_tail.item(lane)
+        if tail == -1:
+            self.lane_head[lane] = car
+        else:
+            self.car_next[tail] = car
+        self.lane_tail[lane] = car
+        self.lane_length[lane] += 1
+
+    def departure(self, lane):
+        # Arrival time of the first car of the lane, the lane must not be empty
+        car = self.lane_head.item(lane)
+        head = self.car_next.item(car)
+        self.lane_head[lane] = head
+        if head == -1:
+            self.lane_tail[lane] = -1
+        self.lane_length[lane] -= 1
+        self.car_next[car] = self.free_head
+        self.car_lane[car] = -1
+        self.free_head = car
+        return self.car_time.item(car)
+
+    def get_wait_time_left(self, clock, n_lanes):
+        # Total time waited per lane by the cars that are still queued, added in order of arrival so the sums do not
+        # depend on which slots the cars got
+        queued = np.flatnonzero(self.car_lane >= 0)
+        queued = queued[np.lexsort((self.car_time[queued], self.car_lane[queued]))]
+        return np.bincount(self.car_lane[queued], clock - self.car_time[queued], minlength=n_lanes)
+
+
+class NetworkRegion:
+    # The intersections of one region of the network with their own future event list. Every intersection follows the
+    # rules of main(): arrivals pass on an empty green lane and queue otherwise, cars leave on green and with some
+    # probability on orange, and the fixed time or smart controller drives the lights. Cars that leave a lane, or pass
+    # it, drive on to the next lane of their route. Every intersection draws from its own random streams, so the
+    # results do not depend on how the network is split in regions.
+    def __init__(self, network, intersections, region_of_lane, region, seed, rush_hour=NO_RUSH_HOUR, flow_cars=2,
+                 flow_first_car=8, orange_time=4, block_size=256):
+        self.network = network
+        self.intersections = np.asarray(intersections, dtype=np.int64)
+        self.region_of_lane = region_of_lane
+        self.region = region
+        self.rush_hour = rush_hour
+        self.flow_cars = flow_cars
+        self.flow_first_car = flow_first_car
+        self.orange_time = orange_time
+        self.total_seconds = network.light_times.sum(axis=1)
+        n_roads = len(LANES)
+
+        # Streams per intersection, only the boundary lanes need their own beta buffer
+        self.exponentials = {}
+        self.uniforms = {}
+        self.beta_buffers = {}
+        for intersection in self.intersections.tolist():
+            rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(intersection,)))
+            self.exponentials[intersection] = VariateBuffer(rng.standard_exponential, block_size)
+            self.uniforms[intersection] = VariateBuffer(rng.random, block_size)
+            for lane in range(intersection * n_roads, (intersection + 1) * n_roads):
+                params = network.arrival_params[lane]
+                if not np.isnan(params[0]):
+                    self.beta_buffers[lane] = VariateBuffer(partial(rng.beta, params[1], params[2]), block_size)
+
+        self.pool = CarPool(network.n_lanes)
+        self.cars_at = np.zeros(network.n_intersections, dtype=np.int64)
+        self.light_state = np.full(network.n_intersections, network.starting_policy, dtype=np.int64)
+        self.time_last_orange = np.zeros(network.n_intersections)
+        # Light changes that are cancelled by the smart controller stay in the heap, only the light change with the
+        # current token of the intersection is handled
+        self.light_token = np.zeros(network.n_intersections, dtype=np.int64)
+        self.wait_time = np.zeros(network.n_lanes)
+        self.cars = np.zeros(network.n_lanes, dtype=np.int64)
+        self.num_events = 0
+        self.events = []
+        self.counter = itertools.count()
+        self.outgoing = []
+
+        # Same first events as init_simulation, the light cycle of every intersection starts at its offset
+        for lane, buffer in self.beta_buffers.items():
+            self.schedule(-0.5 + network.arrival_params.item(lane, 0) * buffer.next(), ARRIVAL, lane)
+        for intersection in self.intersections.tolist():
+            for road in np.flatnonzero(network.open_lanes[intersection, network.starting_policy]).tolist():
+                self.schedule(flow_first_car * self.exponentials[intersection].next(), DEPARTURE,
+                              intersection * n_roads + road)
+            self.schedule_light_change(intersection, network.offsets.item(intersection) +
+                                       network.light_times.item(intersection, network.starting_policy - 1), 5)
+
+    def schedule(self, time, kind, target, extra=0):
+        heapq.heappush(self.events, (time, EVENT_PRIORITY[kind], next(self.counter), kind, target, extra))
+
+    def schedule_light_change(self, intersection, time, new_light):
+        self.light_token[intersection] += 1
+        self.schedule(time, LIGHT_CHANGE, intersection, (new_light, self.light_token.item(intersection)))
+
+    def route(self, lane, time):
+        # Send a car that leaves the lane to the next lane of its route, cars for other regions are collected in
+        # outgoing
+        network = self.network
+        intersection = lane // len(LANES)
+        start, end = network.route_start.item(lane), network.route_start.item(lane + 1)
+        choice = start + int(np.searchsorted(network.route_cumulative[start:end], self.uniforms[intersection].next(),
+                                             side='right'))
+        choice = min(choice, end - 1)
+        next_lane = network.route_lanes.item(choice)
+        if next_lane >= 0:
+            time = time + network.route_min_time.item(choice) + \
+                network.route_extra_time.item(choice) * self.exponentials[intersection].next()
+            if self.region_of_lane.item(next_lane) == self.region:
+                self.schedule(time, ROUTED_ARRIVAL, next_lane)
+            else:
+                self.outgoing.append((time, next_lane))
+
+    def leave(self, lane, time):
+        arrival_time = self.pool.departure(lane)
+        intersection = lane // len(LANES)
+        self.cars_at[intersection] -= 1
+        self.wait_time[lane] += time - arrival_time
+        self.cars[lane] += 1
+        self.route(lane, time)
+        self.schedule(time + self.flow_cars * self.exponentials[intersection].next(), DEPARTURE, lane)
+
+    def run(self, window_end, incoming_times, incoming_lanes):
+        # Add the cars that arrive from other regions and handle all events before window_end. Returns the times and
+        # lanes of the cars that leave for other regions.
+        network, pool, n_roads = self.network, self.pool, len(LANES)
+        open_lanes, light_state = network.open_lanes, self.light_state
+        order = np.lexsort((incoming_lanes, incoming_times))
+        for time, lane in zip(incoming_times[order].tolist(), incoming_lanes[order].tolist()):
+            self.schedule(time, ROUTED_ARRIVAL, lane)
+        self.outgoing = []
+
+        events = self.events
+        while events and events[0][0] < window_end:
+            clock, _, _, kind, target, extra = heapq.heappop(events)
+
+            if kind == ARRIVAL or kind == ROUTED_ARRIVAL:
+                lane = target
+                intersection = lane // n_roads
+                if open_lanes[intersection, light_state.item(intersection), lane % n_roads] and \
+                        not pool.lane_length.item(lane):
+                    self.route(lane, clock)
+                else:
+                    pool.enqueue(lane, clock)
+                    self.cars_at[intersection] += 1
+
+                # Only arrivals from outside the network bring the next arrival
+                if kind == ARRIVAL:
+                    multiplier = rush_hour_multiplier(clock, self.rush_hour)
+                    self.schedule(min(-0.5 + network.arrival_params.item(lane, 0) / multiplier *
+                                      self.beta_buffers[lane].next(), 1) + clock, ARRIVAL, lane)
+
+            elif kind == DEPARTURE:
+                lane = target
+                intersection = lane // n_roads
+                light = light_state.item(intersection)
+                if not pool.lane_length.item(lane):
+                    pass
+                elif open_lanes[intersection, light, lane % n_roads]:
+                    self.leave(lane, clock)
+
+                    # The smart controller switches to orange as soon as one of the open lanes is empty
+                    if network.smart[intersection]:
+                        first = intersection * n_roads
+                        open_now = np.flatnonzero(open_lanes[intersection, light])
+                        if (pool.lane_length[first + open_now] == 0).any():
+                            self.schedule_light_change(intersection, clock, 5)
+
+                elif light == 5:
+                    time_since_orange = clock - self.time_last_orange.item(intersection)
+                    if self.uniforms[intersection].next() > time_since_orange / self.orange_time:
+                        self.leave(lane, clock)
+
+            else:
+                intersection = target
+                new_light, token = extra
+                if token != self.light_token.item(intersection):
+                    continue
+                old_light = light_state.item(intersection)
+                light_state[intersection] = new_light
+
+                if new_light == 5:
+                    self.time_last_orange[intersection] = clock
+                    self.schedule_light_change(intersection, clock + self.orange_time,
+                                               1 if old_light // 4 == 1 else old_light + 1)
+                else:
+                    open_now = intersection * n_roads + np.flatnonzero(open_lanes[intersection, new_light])
+                    if network.smart[intersection]:
+                        # Green time in proportion to the share of the cars of the intersection that wait at the
+                        # open lanes, straight to orange if they are empty and after 10 seconds if the intersection
+                        # is empty
+                        cars_open = pool.lane_length[open_now].sum()
+                        cars_at = self.cars_at.item(intersection)
+                        if cars_at == 0:
+                            self.schedule_light_change(intersection, clock + 10, 5)
+                        elif cars_open == 0:
+                            self.schedule_light_change(intersection, clock, 5)
+                        else:
+                            self.schedule_light_change(intersection, clock + self.total_seconds.item(intersection) *
+                                                       cars_open / cars_at, 5)
+                    else:
+                        self.schedule_light_change(intersection, clock + network.light_times.item(
+                            intersection, new_light - 1), 5)
+
+                    for lane in open_now.tolist():
+                        self.schedule(clock + self.flow_first_car * self.exponentials[intersection].next(), DEPARTURE,
+                                      lane)
+
+            self.num_events += 1
+
+        outgoing = np.array(self.outgoing, dtype=float).reshape(-1, 2)
+        return outgoing[:, 0], outgoing[:, 1].astype(np.int64)
+
+    def finish(self, clock):
+        # Time waited and number of cars per lane, including the cars that are still queued at clock
+        return self.wait_time + self.pool.get_wait_time_left(clock, self.network.n_lanes), \
+            self.cars + self.pool.lane_length, self.num_events
+
+
+def partition_intersections(n_intersections, n_regions):
+    # Split the intersections in n_regions blocks of consecutive numbers, for a grid these are bands of rows
+    return np.array_split(np.arange(n_intersections), n_regions)
+
+
+def region_worker(connection, network, partition, regions, seed, options):
+    # Runs the given regions in a worker process, every message is a window end and the arrivals per region, the
+    # answer the cars that leave each region. None ends the run and returns the results of the regions. An exception
+    # is sent back instead of an answer, so the parent can raise it again.
+    try:
+        region_of_lane = region_of_lanes(partition)
+        states = None
+        while True:
+            message = connection.recv()
+            if states is None:
+                states = {region: NetworkRegion(network, partition[region], region_of_lane, region, seed, **options)
+                          for region in regions}
+            if message[0] is None:
+                connection.send({region: state.finish(message[1]) for region, state in states.items()})
+                break
+            window_end, incoming = message
+            connection.send({region: states[region].run(window_end, *incoming[region]) for region in regions})
+    except EOFError:
+        # The parent is gone
+        pass
+    except Exception as error:
+        connection.send(error)
+    finally:
+        connection.close()
+
+
+def receive(connection):
+    # Answer of a region worker, raises the exception of the worker if it failed
+    answer = connection.recv()
+    if isinstance(answer, Exception):
+        raise answer
+    return answer
+
+
+def region_of_lanes(partition):
+    region_of_intersection = np.empty(sum(len(part) for part in partition), dtype=np.int64)
+    for region, part in enumerate(partition):
+        region_of_intersection[part] = region
+    return np.repeat(region_of_intersection, len(LANES))
+
+
+def simulate_network(network, max_time, rush_hour=NO_RUSH_HOUR, flow_cars=2, flow_first_car=8, orange_time=4,
+                     seed=None, n_regions=1, n_workers=1):
+    # Runs the network split in n_regions regions on n_workers processes. The regions handle their events in windows of
+    # the shortest travel time between intersections, a car that leaves in a window can not arrive before the next one,
+    # so the regions only swap the cars that cross a border at the end of every window. Because every intersection
+    # has its own random streams the results do not depend on n_regions or n_workers. Returns the average wait per car,
+    # the average wait per lane and the number of events.
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    n_regions = min(n_regions, network.n_intersections)
+    partition = partition_intersections(network.n_intersections, n_regions)
+    region_of_lane = region_of_lanes(partition)
+    options = {'rush_hour': rush_hour, 'flow_cars': flow_cars, 'flow_first_car': flow_first_car,
+               'orange_time': orange_time}
+
+    lookahead = network.get_min_travel_time() if n_regions > 1 else np.inf
+    if lookahead <= 0:
+        raise ValueError('Running in regions needs a positive minimum travel time between intersections')
+
+    no_arrivals = (np.empty(0), np.empty(0, dtype=np.int64))
+    incoming = {region: no_arrivals for region in range(n_regions)}
+    n_workers = min(n_workers, n_regions)
+    workers = []
+    if n_workers == 1:
+        states = [NetworkRegion(network, partition[region], region_of_lane, region, seed, **options)
+                  for region in range(n_regions)]
+
+        def step(window_end, incoming):
+            return {region: state.run(window_end, *incoming[region]) for region, state in enumerate(states)}
+
+        def finish():
+            return {region: state.finish(max_time) for region, state in enumerate(states)}
+    else:
+        for regions in np.array_split(np.arange(n_regions), n_workers):
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=region_worker, args=(child, network, partition, regions.tolist(),
+                                                                          seed, options), daemon=True)
+            process.start()
+            # Only the worker keeps its end open, so the parent gets an EOFError instead of waiting forever if the
+            # worker dies
+            child.close()
+            workers.append((parent, process, regions.tolist()))
+
+        def step(window_end, incoming):
+            for connection, _, regions in workers:
+                connection.send((window_end, {region: incoming[region] for region in regions}))
+            outgoing = {}
+            for connection, _, _ in workers:
+                outgoing.update(receive(connection))
+            return outgoing
+
+        def finish():
+            results = {}
+            for connection, process, _ in workers:
+                connection.send((None, max_time))
+                results.update(receive(connection))
+                process.join()
+            return results
+
+    # Stop every worker however the run ends, a worker that raised or died leaves the others waiting for a message
+    try:
+        window_start = -np.inf
+        while window_start < max_time:
+            window_end = min(max(window_start, 0) + lookahead, max_time)
+            outgoing = step(window_end, incoming)
+
+            # Send the cars that cross a border to the region of their next lane
+            times = np.concatenate([outgoing[region][0] for region in range(n_regions)])
+            lanes = np.concatenate([outgoing[region][1] for region in range(n_regions)])
+            destination = region_of_lane[lanes]
+            incoming = {region: (times[destination == region], lanes[destination == region])
+                        for region in range(n_regions)}
+            window_start = window_end
+
+        wait_time = np.zeros(network.n_lanes)
+        cars = np.zeros(network.n_lanes, dtype=np.int64)
+        num_events = 0
+        for region_wait, region_cars, region_events in finish().values():
+            wait_time += region_wait
+            cars += region_cars
+            num_events += region_events
+    finally:
+        for connection, process, _ in workers:
+            connection.close()
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+    average_wait_per_lane = np.divide(wait_time, cars, out=np.full(network.n_lanes, np.nan), where=cars > 0)
+    return wait_time.sum() / max(cars.sum(), 1), average_wait_per_lane, num_events
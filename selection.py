@@ -0,0 +1,84 @@
+from estimation import confidence_interval
+from main import run_parallel
+import itertools
+import math
+import numpy as np
+
+
+def candidate_grid(green_times, smart_options=(False, True)):
+    # All [t1, t2, t3, t4, smart] schedules with every green time taken from green_times
+    return [list(times) + [smart] for times in itertools.product(green_times, repeat=4) for smart in smart_options]
+
+
+def successive_halving(policy, candidates, time_horizon, road_list, rush_hours, replications=2, eta=2,
+                       max_replications=32, confidence=0.95, seed=None, n_workers=None, cache_path=None):
+    # Screen many light schedules. Every round all remaining candidates are run up to the current number of
+    # replications, the best 1 / eta of them go on to the next round, which has eta times as many replications. Stops
+    # when one candidate is left or the replications reach max_replications. Replication i of every candidate uses the
+    # same random numbers, so candidates are compared on the same traffic and differences are paired.
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+        print('Master seed: {}'.format(seed))
+
+    waits = [[] for _ in candidates]
+    last_round = [0] * len(candidates)
+    survivors = list(range(len(candidates)))
+    current_round = 0
+    while True:
+        tasks = []
+        owners = []
+        for j in survivors:
+            tasks.extend((candidates[j], i) for i in range(len(waits[j]), replications))
+            owners.extend([j] * (replications - len(waits[j])))
+        results_tasks = run_parallel(policy, time_horizon, road_list, rush_hours, tasks, seed, n_workers,
+                                     common_arrivals=True, cache_path=cache_path)
+        for j, (average_wait_time, _) in zip(owners, results_tasks):
+            waits[j].append(average_wait_time)
+        for j in survivors:
+            last_round[j] = current_round
+        print('Round {}: {} candidates, {} replications'.format(current_round, len(survivors), replications))
+
+        if len(survivors) == 1 or replications >= max_replications:
+            break
+        survivors.sort(key=lambda j: np.mean(waits[j]))
+        survivors = survivors[:math.ceil(len(survivors) / eta)]
+        replications = min(replications * eta, max_replications)
+        current_round += 1
+
+    # Rank by the last round reached and then by mean. Every candidate is compared with the best one on the
+    # replications they have in common.
+    order = sorted(range(len(candidates)), key=lambda j: (-last_round[j], np.mean(waits[j])))
+    best = order[0]
+    table = []
+    for rank, j in enumerate(order):
+        mean, half_width = confidence_interval(waits[j], confidence)
+        n_common = min(len(waits[j]), len(waits[best]))
+        difference, difference_half_width = confidence_interval(
+            np.array(waits[j][:n_common]) - np.array(waits[best][:n_common]), confidence)
+        if j == best:
+            statement = 'best'
+        elif difference - difference_half_width > 0:
+            statement = 'worse than best'
+        else:
+            statement = 'not distinguishable from best'
+        table.append({'rank': rank + 1, 'schedule': candidates[j], 'mean': mean, 'half_width': half_width,
+                      'replications': len(waits[j]), 'difference': difference,
+                      'difference_half_width': difference_half_width, 'statement': statement})
+    return table
+
+
+def print_ranking(table, top=None):
+    for row in table[:top]:
+        print('{:>4} {}: {:.2f} +- {:.2f} ({} replications), {:+.2f} +- {:.2f} vs best, {}'.format(
+            row['rank'], row['schedule'], row['mean'], row['half_width'], row['replications'], row['difference'],
+            row['difference_half_width'], row['statement']))
+
+
+if __name__ == '__main__':
+    roads_list = {'NS': [66, 0.971, 2.04], 'NL': [66, 0.971, 2.04], 'ES': [72, 0.963, 1.99], 'EL': [72, 0.963, 1.99],
+                  'SS': [123, 0.968, 3.44], 'SL': [123, 0.968, 3.44], 'WS': [69, 0.634, 1.61], 'WL': [69, 0.634, 1.61]}
+    policies = {1: ['SL', 'NL'], 2: ['NS', 'SS'], 3: ['ES', 'WS'], 4: ['WL', 'EL'], 5: ['']}
+    rush_hour = [21600, 36000, 54000, 68400]
+
+    ranking = successive_halving(policies, candidate_grid([20, 40, 60]), 3600, roads_list, rush_hour, seed=0)
+    print_ranking(ranking, top=20)
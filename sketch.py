@@ -0,0 +1,134 @@
+import math
+
+import numpy as np
+
+
+class LogHistogram:
+    # Streaming quantile sketch of non-negative values, like the wait times of the cars. The range from min_value to
+    # max_value is split into bins_per_decade bins per factor 10 of equal width on a log scale, so a quantile is off by
+    # at most half a bin, about 1.2% of the value with the default 100 bins per decade. Values below min_value are
+    # counted in the first bin and reported as 0, values above max_value in the last bin. Only the counts are kept, so
+    # memory does not depend on the number of values, and histograms with the same bins are merged by adding counts.
+    # add and add_many of fewer than block_size values only append to a buffer that is counted with one vectorized
+    # count_many once it holds block_size values, every method that reads the counts empties the buffer first.
+    def __init__(self, min_value=0.01, max_value=1e6, bins_per_decade=100, block_size=1024):
+        self.min_value = min_value
+        self.max_value = max_value
+        self.bins_per_decade = bins_per_decade
+        self.log_min = math.log10(min_value)
+        self.n_bins = math.ceil((math.log10(max_value) - self.log_min) * bins_per_decade) + 2
+        self.counts = np.zeros(self.n_bins, dtype=np.int64)
+        self.total = 0.0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+        self.block_size = block_size
+        self.buffer = []
+
+    def get_bin(self, value):
+        if value < self.min_value:
+            return 0
+        return min(int((math.log10(value) - self.log_min) * self.bins_per_decade) + 1, self.n_bins - 1)
+
+    def add(self, value):
+        self.buffer.append(value)
+        if len(self.buffer) >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            values = self.buffer
+            self.buffer = []
+            self.count_many(values)
+
+    def get_bins(self, values):
+        # get_bin of every value in an array
+        values = np.asarray(values, dtype=float)
+        bins = np.zeros(len(values), dtype=np.int64)
+        positive = values >= self.min_value
+        bins[positive] = np.minimum((np.log10(values[positive]) - self.log_min) * self.bins_per_decade + 1,
+                                    self.n_bins - 1).astype(np.int64)
+        return bins
+
+    def add_many(self, values):
+        # Fewer values than a block are buffered like with add
+        if len(values) < self.block_size:
+            self.buffer.extend(values)
+            if len(self.buffer) >= self.block_size:
+                self.flush()
+            return
+        self.count_many(values)
+
+    def count_many(self, values):
+        values = np.asarray(values, dtype=float)
+        if not len(values):
+            return
+        self.counts += np.bincount(self.get_bins(values), minlength=self.n_bins)
+        self.total += values.sum()
+        self.minimum = min(self.minimum, values.min())
+        self.maximum = max(self.maximum, values.max())
+
+    @classmethod
+    def from_counts(cls, counts, total, minimum, maximum, **bins):
+        # Histogram with counts that were collected elsewhere with get_bins, for instance by the vectorized engine
+        histogram = cls(**bins)
+        histogram.counts += counts
+        histogram.total = total
+        histogram.minimum = minimum
+        histogram.maximum = maximum
+        return histogram
+
+    def merge(self, other):
+        # Add the counts of another histogram with the same bins, for instance of another replication
+        if (self.min_value, self.max_value, self.bins_per_decade) != \
+                (other.min_value, other.max_value, other.bins_per_decade):
+            raise ValueError('Only histograms with the same bins can be merged')
+        self.flush()
+        other.flush()
+        self.counts += other.counts
+        self.total += other.total
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        return self
+
+    def copy(self):
+        histogram = LogHistogram(self.min_value, self.max_value, self.bins_per_decade, self.block_size)
+        return histogram.merge(self)
+
+    def get_count(self):
+        self.flush()
+        return int(self.counts.sum())
+
+    def get_mean(self):
+        count = self.get_count()
+        return self.total / count if count else math.nan
+
+    def quantiles(self, qs):
+        # Value at every quantile in qs, the middle of its bin on the log scale, within the smallest and largest value
+        count = self.get_count()
+        if not count:
+            return [math.nan for _ in qs]
+        cumulative = np.cumsum(self.counts)
+        bins = np.searchsorted(cumulative, np.maximum(np.asarray(qs, dtype=float) * count, 1))
+        values = 10 ** (self.log_min + (bins - 0.5) / self.bins_per_decade)
+        values[bins == 0] = 0.0
+        return np.clip(values, max(self.minimum, 0.0), self.maximum).tolist()
+
+    def quantile(self, q):
+        return self.quantiles([q])[0]
+
+
+def merge_histograms(histograms):
+    # One histogram with the counts of all the given histograms, which are not changed
+    histograms = list(histograms)
+    merged = histograms[0].copy()
+    for histogram in histograms[1:]:
+        merged.merge(histogram)
+    return merged
+
+
+def road_quantiles(road_histograms, qs=(0.5, 0.9, 0.99)):
+    # Quantiles of a dictionary of histograms per road, of all roads together under 'all' and of every road
+    quantiles = {'all': dict(zip(qs, merge_histograms(road_histograms.values()).quantiles(qs)))}
+    for road, histogram in road_histograms.items():
+        quantiles[road] = dict(zip(qs, histogram.quantiles(qs)))
+    return quantiles
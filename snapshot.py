@@ -0,0 +1,37 @@
+import pickle
+
+
+class Snapshot:
+    # Full state of a run of main() at the end of an event: the queues and lights, the pending events, the random
+    # variates including the state of their Generator, the position in pre-generated arrival streams and the metrics
+    # collected so far. main(..., snapshot=...) continues a run from it, a copy is made first so one snapshot can start
+    # many runs.
+    def __init__(self, states, scheduled_events, variates, arrival_cursor, metrics, totals):
+        self.states = states
+        self.scheduled_events = scheduled_events
+        self.variates = variates
+        self.arrival_cursor = arrival_cursor
+        self.metrics = metrics
+        # total_wait_time, total_cars, road_specific_wait and road_specific_cars of main()
+        self.totals = totals
+
+    def get_clock(self):
+        return self.states.get_clock()
+
+    def copy(self):
+        return pickle.loads(pickle.dumps(self, pickle.HIGHEST_PROTOCOL))
+
+    def reset_metrics(self):
+        # Only measure from the time of the snapshot on. Cars that are already waiting count from their arrival time
+        # once they leave.
+        self.metrics.reset(self.get_clock())
+        self.totals = (0, 0, {road: 0 for road in self.totals[2]}, {road: 0 for road in self.totals[3]})
+
+    def save(self, path):
+        with open(path, 'wb') as file:
+            pickle.dump(self, file, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as file:
+            return pickle.load(file)
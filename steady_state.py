@@ -0,0 +1,44 @@
+from arrivals import NO_RUSH_HOUR
+from estimation import BatchMeans
+from event_trace import ARRIVAL_QUEUE, DEPARTURE, ORANGE_DEPARTURE, LIGHT_CHANGE
+from main import main
+import numpy as np
+
+
+class SteadyStateCollector:
+    # Used as tracer of main(). Keeps streaming batch means of the wait of every departing car and of the number of
+    # cars in the system over time, the memory used does not grow with the length of the run.
+    def __init__(self, max_batches=1024, occupancy_batch_time=10.0):
+        self.wait = BatchMeans(1.0, max_batches)
+        self.occupancy = BatchMeans(occupancy_batch_time, max_batches)
+        self.total_cars = 0
+        self.last_time = 0.0
+
+    def record(self, time, kind, lane, light, queue_length, wait=np.nan):
+        # Only time moving forward counts for the occupancy, arrivals can be handled slightly before the clock
+        if time > self.last_time:
+            self.occupancy.add(self.total_cars, time - self.last_time)
+            self.last_time = time
+
+        if kind == ARRIVAL_QUEUE:
+            self.total_cars += 1
+        elif kind == DEPARTURE or kind == ORANGE_DEPARTURE:
+            self.total_cars -= 1
+            self.wait.add(wait)
+        elif kind == LIGHT_CHANGE:
+            self.total_cars = queue_length
+
+    def estimate(self, confidence=0.95, n_batches=20):
+        return {'wait': self.wait.estimate(confidence, n_batches),
+                'occupancy': self.occupancy.estimate(confidence, n_batches)}
+
+
+def estimate_steady_state(light_policy, max_time, roads, rush_hour=NO_RUSH_HOUR, light_times=[40, 30, 20, 60],
+                          smart=False, orange_time=4, rng=None, confidence=0.95, n_batches=20, max_batches=1024):
+    # One long run of main() for a scenario without changes in the arrival rates. MSER deletes the warm-up and batch
+    # means give the confidence intervals of the steady state wait per car and number of cars in the system. Both
+    # estimates have stationary=False if no steady state was found, for instance when the queues keep growing.
+    collector = SteadyStateCollector(max_batches)
+    main(light_policy, max_time, roads, rush_hour, orange_time=orange_time, light_times=light_times, verbose=0,
+         smart=smart, rng=rng, tracer=collector)
+    return collector.estimate(confidence, n_batches)
@@ -0,0 +1,52 @@
+import math
+
+import numpy as np
+import pytest
+
+from vectorized import PER_REPLICATION, LockstepStates, compare_engines, main_vectorized
+
+
+ROADS = {'NS': [66, 0.971, 2.04], 'NL': [66, 0.971, 2.04], 'ES': [72, 0.963, 1.99], 'EL': [72, 0.963, 1.99],
+         'SS': [123, 0.968, 3.44], 'SL': [123, 0.968, 3.44], 'WS': [69, 0.634, 1.61], 'WL': [69, 0.634, 1.61]}
+POLICIES = {1: ['SL', 'NL'], 2: ['NS', 'SS'], 3: ['ES', 'WS'], 4: ['WL', 'EL'], 5: ['']}
+RUSH_HOUR = [21600, 36000, 54000, 68400]
+
+
+def test_engines_are_statistically_equivalent():
+    # 30 replications per engine with fixed seeds. The mean average wait may not differ at the 1% level, and no road at
+    # the 1% level divided over the 8 roads.
+    scalar_mean, vectorized_mean, t_statistic, p_value, per_road = compare_engines(
+        POLICIES, 1800, ROADS, RUSH_HOUR, 30, light_times=[40, 40, 40, 60], orange_time=4, seed=0)
+    assert abs(t_statistic) < 2.58
+    assert p_value > 0.01
+    assert set(per_road) == set(ROADS)
+    for road, (scalar_road, vectorized_road, road_t) in per_road.items():
+        assert math.isfinite(scalar_road) and math.isfinite(vectorized_road)
+        assert abs(road_t) < 3.23, road
+
+
+def test_batches_give_one_result_per_replication():
+    results = main_vectorized(POLICIES, 600, ROADS, RUSH_HOUR, 5, orange_time=4, rng=np.random.default_rng(0),
+                              batch_size=2)
+    assert len(results) == 5
+    for average_wait, average_wait_per_road, metrics in results:
+        assert average_wait > 0
+        assert set(average_wait_per_road) == set(ROADS)
+
+
+def test_split_keeps_the_rows_of_every_replication():
+    states = LockstepStates(5, POLICIES, ROADS, n_bins=10)
+    states.clock[:] = np.arange(5)
+    states.buffers[:, :, 0] = np.arange(5)[:, None]
+    first, second = states.split()
+    assert first.replications.tolist() == [0, 1, 2] and second.replications.tolist() == [3, 4]
+    for half in (first, second):
+        assert all(len(getattr(half, name)) == half.n_replications for name in PER_REPLICATION)
+        assert half.capacity == states.capacity
+        assert half.clock.tolist() == half.replications.tolist()
+        assert half.buffers[:, 0, 0].tolist() == half.replications.tolist()
+
+
+def test_smart_controller_is_refused():
+    with pytest.raises(ValueError):
+        main_vectorized(POLICIES, 600, ROADS, RUSH_HOUR, 2, smart=True)
@@ -0,0 +1,40 @@
+from functools import partial
+
+
+class VariateBuffer:
+    # Hands out samples one at a time from a block that is drawn with a single vectorized call. A new block is only
+    # drawn once the previous one is used up.
+    def __init__(self, draw_block, block_size=4096):
+        self.draw_block = draw_block
+        self.block_size = block_size
+        self.values = []
+        self.position = 0
+
+    def next(self):
+        if self.position == len(self.values):
+            self.values = self.draw_block(self.block_size).tolist()
+            self.position = 0
+        value = self.values[self.position]
+        self.position += 1
+        return value
+
+
+class RandomVariates:
+    # All random draws of the simulation come from one numpy Generator. Every lane has its own beta buffer for the
+    # arrivals and its own exponential buffer for the departures, the orange light decisions share a uniform buffer.
+    def __init__(self, rng, roads, block_size=4096):
+        self.rng = rng
+        self.beta_buffers = {road: VariateBuffer(partial(rng.beta, params[1], params[2]), block_size)
+                             for road, params in roads.items()}
+        self.exponential_buffers = {road: VariateBuffer(rng.standard_exponential, block_size) for road in roads}
+        self.uniform_buffer = VariateBuffer(rng.random, block_size)
+
+    def beta(self, road):
+        # Beta(b, c) sample with the parameters of the road
+        return self.beta_buffers[road].next()
+
+    def exponential(self, road, scale):
+        return scale * self.exponential_buffers[road].next()
+
+    def uniform(self):
+        return self.uniform_buffer.next()